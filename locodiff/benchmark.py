@@ -0,0 +1,54 @@
+import time
+import torch
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_fn(fn, *args, device="cpu", num_warmup=3, num_iters=10, **kwargs) -> float:
+    """
+    Mean wall time of fn(*args, **kwargs) in milliseconds
+    """
+    for _ in range(num_warmup):
+        fn(*args, **kwargs)
+    synchronize(device)
+
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn(*args, **kwargs)
+    synchronize(device)
+    return (time.perf_counter() - start) / num_iters * 1e3
+
+
+def format_table(rows: list[dict], float_fmt: str = ".3f") -> str:
+    """
+    Render a list of dicts with the same keys as a markdown table
+    """
+    headers = list(rows[0].keys())
+
+    def fmt(v):
+        return f"{v:{float_fmt}}" if isinstance(v, float) else str(v)
+
+    lines = [
+        "| " + " | ".join(headers) + " |",
+        "|" + "|".join("---" for _ in headers) + "|",
+    ]
+    for row in rows:
+        lines.append("| " + " | ".join(fmt(row[h]) for h in headers) + " |")
+    return "\n".join(lines)
+
+
+def peak_memory_mb(fn, *args, device="cpu", **kwargs) -> float:
+    """
+    Peak allocated memory while running fn, only tracked on CUDA
+    """
+    if torch.device(device).type != "cuda":
+        return float("nan")
+    synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    start = torch.cuda.memory_allocated(device)
+    fn(*args, **kwargs)
+    synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - start) / 2**20
@@ -1,14 +1,26 @@
 import h5py
+import hashlib
+import json
 import logging
+import math
+import numpy as np
 import os
-import pickle
+import shutil
+import tempfile
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from torch.utils.data import DataLoader, Dataset, Subset, random_split
 
 import minari
 
 log = logging.getLogger(__name__)
 
+# per-step arrays of an episode
+EPISODE_KEYS = ("obs", "action")
+# bump when the preprocessing of the episodes changes, to invalidate caches
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "locodiff")
+
 
 class ExpertDataset(Dataset):
     def __init__(
@@ -17,203 +29,544 @@ class ExpertDataset(Dataset):
         T_cond: int,
         task_name: str,
         device="cpu",
+        mmap_dir: str | None = None,
+        cache_dir: str | None = DEFAULT_CACHE_DIR,
+        cache_max_gb: float = 20.0,
     ):
         self.T_cond = T_cond
         self.device = device
 
+        dataset_path = None
         if data_directory is not None:
             # build path
             current_dir = os.path.dirname(os.path.realpath(__file__))
             dataset_path = current_dir + "/../" + data_directory
-            log.info(f"Loading data from {data_directory}")
-
-            data = {}
-            # load data
-            with h5py.File(dataset_path, "r") as f:
-
-                def load_dataset(name, obj):
-                    if isinstance(obj, h5py.Dataset):
-                        data[name] = obj[:]
-
-                f.visititems(load_dataset)
 
-            # (B, T, D)
-            for k, v in data.items():
-                data[k] = torch.from_numpy(v).transpose(0, 1)
-
-            # build obs
-            if task_name.startswith("Isaac-Locodiff"):
-                obs = torch.cat((data["data/root_pos"], data["data/obs"]), dim=-1)
-                if task_name == "Isaac-Locodiff-no-cmd":
-                    obs = torch.cat([obs[..., :59], obs[..., 62:]], dim=-1)
-            else:
-                obs = data["data/obs"]
-            # get other data
-            actions = data["data/actions"]
-            first_steps = data["data/first_steps"]
-
-            # add first step flages to episode starts
-            first_steps[:, 0] = 1
-            # find episode ends
-            first_steps_flat = first_steps.reshape(-1)
-            split_indices = torch.where(first_steps_flat == 1)[0]
-            # split the sequences at episode ends
-            obs_splits = self.split_eps(obs, split_indices)
-            actions_splits = self.split_eps(actions, split_indices)
+        # converted datasets are cached by source and preprocessing
+        cached = mmap_dir is None and cache_dir is not None
+        if cached:
+            params = self.cache_params(dataset_path, task_name)
+            mmap_dir = os.path.join(cache_dir, f"{task_name}-{cache_key(params)}")
 
+        if mmap_dir is not None and os.path.exists(mmap_dir):
+            # converted before, only the index is read
+            self.data, self.lengths = read_episodes(mmap_dir)
+            log.info(f"Memory-mapped data from {mmap_dir}")
         else:
-            dataset_path = f"dataset_{task_name}.pkl"
-            if os.path.exists(dataset_path):
-                # load pre-processed dataset
-                obs_splits, actions_splits = self.load_dataset(dataset_path)
-                print("[INFO] Loaded pre-processed dataset")
+            if dataset_path is not None:
+                log.info(f"Loading data from {data_directory}")
+                episodes = iter_hdf5_episodes(dataset_path, task_name)
+            else:
+                episodes = self.iter_minari_episodes(task_name)
+
+            if mmap_dir is not None:
+                # convert once, streaming to disk, later runs map the files
+                write_episodes(mmap_dir, episodes)
+                self.data, self.lengths = read_episodes(mmap_dir)
+                if cached:
+                    cleanup_cache(cache_dir, cache_max_gb * 2**30, keep=mmap_dir)
             else:
-                # process the dataset
-                dataset_name = self.get_dataset_name(task_name)
-                dataset = minari.load_dataset(dataset_name)
                 obs_splits, actions_splits = [], []
-                for episode in dataset:
-                    obs_splits.append(
-                        torch.tensor(
-                            episode.observations["observation"], dtype=torch.float
-                        )
-                    )
-                    actions_splits.append(
-                        torch.tensor(episode.actions, dtype=torch.float)
-                    )
-
-                # save the dataset to speedup launch
-                self.save_dataset(obs_splits, actions_splits, dataset_path)
-
-        self.calculate_norm_data(obs_splits, actions_splits)
-
-        # add padding to make all sequences the same length
-        max_len = max(split.shape[0] for split in obs_splits)
-        obs = self.add_padding(obs_splits, max_len, temporal=True)
-        actions = self.add_padding(actions_splits, max_len, temporal=True)
-        masks = self.create_masks(obs_splits, max_len)
-
-        self.data = {"obs": obs, "action": actions, "mask": masks}
+                for obs, actions in episodes:
+                    obs_splits.append(torch.as_tensor(obs))
+                    actions_splits.append(torch.as_tensor(actions))
+                # ragged storage: episodes back to back, plus a zero row that
+                # stands in for the T_cond padding and for steps past an
+                # episode's end
+                self.lengths = torch.tensor([len(split) for split in obs_splits])
+                self.data = {
+                    "obs": self.concat_eps(obs_splits),
+                    "action": self.concat_eps(actions_splits),
+                }
+
+        self.calculate_norm_data(mmap_dir)
+        self.data = {k: v.to(device) for k, v in self.data.items()}
+        self.offsets = torch.cumsum(self.lengths, dim=0) - self.lengths
+        self.lengths, self.offsets = self.lengths.to(device), self.offsets.to(device)
 
         obs_size = list(self.data["obs"].shape)
         action_size = list(self.data["action"].shape)
         log.info(f"Dataset size | Observations: {obs_size} | Actions: {action_size}")
+        report = self.memory_report()
+        log.info(
+            f"Dataset memory | ragged: {report['ragged_mb']:.1f} MB | "
+            f"padded: {report['padded_mb']:.1f} MB"
+        )
 
     def __len__(self):
-        return len(self.data["obs"])
+        return len(self.lengths)
 
     def __getitem__(self, idx):
-        T = self.data["mask"][idx].sum().int().item()
-        return {
-            "obs": self.data["obs"][idx],
-            "action": self.data["action"][idx],
-            "length": T,
-        }
-
-    def split_eps(self, x, split_indices):
-        x = torch.tensor_split(x.reshape(-1, x.shape[-1]), split_indices.tolist())
-        # remove first empty split
-        return x[1:]
-
-    def add_padding(self, splits, max_len, temporal):
-        x = []
-
-        # Make all sequences the same length
-        for split in splits:
-            padded_split = torch.nn.functional.pad(
-                split, (0, 0, 0, max_len - split.shape[0])
-            )
-            x.append(padded_split)
-        x = torch.stack(x)
-
-        if temporal:
-            # Add initial padding to handle episode starts
-            x_pad = torch.zeros_like(x[:, : self.T_cond - 1, :])
-            x = torch.cat([x_pad, x], dim=1)
+        # the episode with its T_cond padding
+        T = self.lengths[idx].item() + self.T_cond - 1
+        episodes = torch.tensor([idx], device=self.device)
+        starts = torch.zeros_like(episodes)
+        window = self.get_windows(episodes, starts, T)
+        return {"obs": window["obs"][0], "action": window["action"][0], "length": T}
+
+    def get_windows(self, episodes, starts, window: int) -> dict:
+        """
+        (B, window, D) windows of the padded episodes, starting at starts
+        """
+        rows = window_rows(
+            self.offsets, self.lengths, episodes, starts, window, self.T_cond
+        )
+        return {k: v[rows] for k, v in self.data.items()}
+
+    def concat_eps(self, splits):
+        zero = torch.zeros_like(splits[0][:1])
+        return torch.cat([*splits, zero])
+
+    def memory_report(self) -> dict:
+        """
+        Bytes of the ragged buffers against the former padded layout with masks
+        """
+        ragged = sum(v.numel() * v.element_size() for v in self.data.values())
+        ragged += (self.lengths.numel() + self.offsets.numel()) * 8
+        padded_len = self.lengths.max().item() + self.T_cond - 1
+        dims = sum(v.shape[-1] for v in self.data.values()) + 1
+        padded = len(self) * padded_len * dims * 4
+        return {"ragged_mb": ragged / 2**20, "padded_mb": padded / 2**20}
+
+    def iter_minari_episodes(self, task_name):
+        dataset = minari.load_dataset(self.get_dataset_name(task_name))
+        for episode in dataset:
+            obs = torch.tensor(episode.observations["observation"], dtype=torch.float)
+            yield obs, torch.tensor(episode.actions, dtype=torch.float)
+
+    def cache_params(self, dataset_path: str | None, task_name: str) -> dict:
+        """
+        Everything the converted episodes depend on. The T_cond padding is
+        applied when reading windows, so it is not part of the cache.
+        """
+        if dataset_path is not None:
+            # a rewritten file changes its size or mtime
+            stat = os.stat(dataset_path)
+            source = {
+                "path": os.path.realpath(dataset_path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
         else:
-            # For non-temporal data, e.g. skills, just take the first timestep
-            x = x[:, 0]
-
-        return x.to(self.device)
-
-    def create_masks(self, splits, max_len):
-        masks = []
-
-        # Create masks to indicate the padding values
-        for split in splits:
-            mask = torch.concatenate(
-                [torch.ones(split.shape[0]), torch.zeros(max_len - split.shape[0])]
-            )
-            masks.append(mask)
-        masks = torch.stack(masks)
-
-        # Add initial padding to handle episode starts
-        masks_pad = torch.ones((masks.shape[0], self.T_cond - 1))
-        masks = torch.cat([masks_pad, masks], dim=1)
-
-        return masks.to(self.device)
-
-    def calculate_norm_data(self, obs_splits, actions_splits):
-        all_obs = torch.cat(obs_splits)[:1000000]
-        all_actions = torch.cat(actions_splits)
-        # all_obs_acts = torch.cat([all_obs, all_actions], dim=-1)
-        all_obs_acts = torch.cat([all_actions, all_obs], dim=-1)
-
-        self.x_mean = all_obs.mean(0)
-        self.x_std = all_obs.std(0)
-        self.x_min = all_obs.min(0).values
-        self.x_max = all_obs.max(0).values
-
-        self.y_mean = all_obs_acts.mean(0)
-        self.y_std = all_obs_acts.std(0)
-        self.y_min = all_obs_acts.min(0).values
-        self.y_max = all_obs_acts.max(0).values
-
-    # Save the dataset
-    def save_dataset(self, obs_splits, actions_splits, filename="dataset.pkl"):
-        with open(filename, "wb") as f:
-            pickle.dump((obs_splits, actions_splits), f)
-
-    # Load the dataset if it exists
-    def load_dataset(self, filename="dataset.pkl"):
-        if os.path.exists(filename):
-            with open(filename, "rb") as f:
-                return pickle.load(f)
-        return None
+            source = {"minari": self.get_dataset_name(task_name)}
+        return {"version": CACHE_VERSION, "task_name": task_name, "source": source}
+
+    def calculate_norm_data(self, stats_dir: str | None = None):
+        """
+        Normalization statistics in one chunked pass over all steps, loaded
+        from stats_dir when a previous run saved them there
+        """
+        stats_path = None
+        if stats_dir is not None:
+            stats_path = os.path.join(stats_dir, "stats.json")
+        if stats_path is not None and os.path.exists(stats_path):
+            with open(stats_path) as f:
+                state = json.load(f)
+            stats = {k: RunningStats.from_state_dict(v) for k, v in state.items()}
+        else:
+            # the last row is the padding row
+            stats = {k: compute_stats(v[:-1]) for k, v in self.data.items()}
+            if stats_path is not None:
+                # the entry is shared, so readers must never see a partial file
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=stats_dir, suffix=".tmp", delete=False
+                ) as f:
+                    json.dump({k: v.state_dict() for k, v in stats.items()}, f)
+                os.replace(f.name, stats_path)
+
+        obs, actions = stats["obs"], stats["action"]
+        dtype = self.data["obs"].dtype
+        self.x_mean = obs.mean.to(dtype)
+        self.x_std = obs.std.to(dtype)
+        self.x_min = obs.min.to(dtype)
+        self.x_max = obs.max.to(dtype)
+
+        # features are ordered [actions, obs]
+        y = RunningStats.concat([actions, obs])
+        self.y_mean = y.mean.to(dtype)
+        self.y_std = y.std.to(dtype)
+        self.y_min = y.min.to(dtype)
+        self.y_max = y.max.to(dtype)
 
     def get_dataset_name(self, task_name):
         difficulty = task_name.split("_")[1].lower().split("-")[0]
         return f"D4RL/pointmaze/{difficulty}-v2"
 
 
+class RunningStats:
+    """
+    Streaming per-feature mean and variance (Welford) with min and max. Stats
+    of separate chunks or shards combine exactly with merge.
+    """
+
+    def __init__(self, dim: int):
+        self.count = 0
+        self.mean = torch.zeros(dim, dtype=torch.float64)
+        self.m2 = torch.zeros(dim, dtype=torch.float64)
+        self.min = torch.full((dim,), float("inf"), dtype=torch.float64)
+        self.max = torch.full((dim,), float("-inf"), dtype=torch.float64)
+
+    def update(self, x: torch.Tensor) -> "RunningStats":
+        x = x.to(torch.float64)
+        chunk = RunningStats(x.shape[-1])
+        chunk.count = len(x)
+        chunk.mean = x.mean(0)
+        chunk.m2 = ((x - chunk.mean) ** 2).sum(0)
+        chunk.min = x.min(0).values
+        chunk.max = x.max(0).values
+        return self.merge(chunk)
+
+    def merge(self, other: "RunningStats") -> "RunningStats":
+        # parallel variance update of Chan et al.
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.min = torch.minimum(self.min, other.min)
+        self.max = torch.maximum(self.max, other.max)
+        self.count = count
+        return self
+
+    @property
+    def std(self) -> torch.Tensor:
+        # unbiased, like torch.std
+        return (self.m2 / (self.count - 1)).sqrt()
+
+    @classmethod
+    def concat(cls, stats: list["RunningStats"]) -> "RunningStats":
+        """
+        Stats of features side by side, all over the same steps
+        """
+        out = cls(0)
+        out.count = stats[0].count
+        for k in ("mean", "m2", "min", "max"):
+            setattr(out, k, torch.cat([getattr(s, k) for s in stats]))
+        return out
+
+    def state_dict(self) -> dict:
+        state = {k: getattr(self, k).tolist() for k in ("mean", "m2", "min", "max")}
+        return {"count": self.count, **state}
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "RunningStats":
+        stats = cls(len(state["mean"]))
+        stats.count = state["count"]
+        for k in ("mean", "m2", "min", "max"):
+            setattr(stats, k, torch.tensor(state[k], dtype=torch.float64))
+        return stats
+
+
+def compute_stats(
+    x: torch.Tensor, chunk_size: int = 2**16, num_workers: int = 4
+) -> RunningStats:
+    """
+    Stats of the rows of x, reading chunk_size rows at a time. Chunks are
+    processed by a thread pool and merged.
+    """
+    dim = x.shape[-1]
+    with ThreadPoolExecutor(num_workers) as pool:
+        shards = pool.map(lambda c: RunningStats(dim).update(c), x.split(chunk_size))
+        stats = RunningStats(dim)
+        for shard in shards:
+            stats.merge(shard)
+    return stats
+
+
+def iter_hdf5_episodes(dataset_path: str, task_name: str, block_bytes: int = 2**28):
+    """
+    Yield the (obs, actions) arrays of each episode. The (T, num_envs, D)
+    datasets are read in contiguous blocks of rows of about block_bytes, and
+    each env's steps are held until its episode ends.
+    """
+    with h5py.File(dataset_path, "r") as f:
+        first_steps = f["data/first_steps"][:]
+        first_steps = first_steps.reshape(first_steps.shape[:2])
+        # every env column starts an episode
+        first_steps[0] = 1
+        num_steps, num_envs = first_steps.shape
+        keys = ["data/obs", "data/actions"]
+        if task_name.startswith("Isaac-Locodiff"):
+            keys.append("data/root_pos")
+        row_bytes = sum(f[k].dtype.itemsize * math.prod(f[k].shape[1:]) for k in keys)
+        block_rows = max(1, block_bytes // row_bytes)
+
+        # unfinished episode of each env, as a list of (obs, actions) parts
+        pending = [[] for _ in range(num_envs)]
+
+        def finish(env):
+            parts, pending[env] = pending[env], []
+            if parts:
+                obs, actions = zip(*parts)
+                yield np.concatenate(obs), np.concatenate(actions)
+
+        for lo in range(0, num_steps, block_rows):
+            hi = min(lo + block_rows, num_steps)
+            # build obs
+            obs = f["data/obs"][lo:hi]
+            if task_name.startswith("Isaac-Locodiff"):
+                obs = np.concatenate([f["data/root_pos"][lo:hi], obs], axis=-1)
+                if task_name == "Isaac-Locodiff-no-cmd":
+                    obs = np.concatenate([obs[..., :59], obs[..., 62:]], axis=-1)
+            actions = f["data/actions"][lo:hi]
+
+            # split at episode starts, the last part carries over to the next block
+            for env in range(num_envs):
+                prev = 0
+                for start in np.flatnonzero(first_steps[lo:hi, env] == 1).tolist():
+                    if start > prev:
+                        pending[env].append(
+                            (obs[prev:start, env], actions[prev:start, env])
+                        )
+                    yield from finish(env)
+                    prev = start
+                # copies, so the block itself is not kept alive
+                pending[env].append(
+                    (obs[prev:, env].copy(), actions[prev:, env].copy())
+                )
+
+        for env in range(num_envs):
+            yield from finish(env)
+
+
+def write_episodes(path: str, episodes):
+    """
+    Stream (obs, actions) episodes to raw files, one per key with the steps
+    back to back and a trailing zero row, plus their lengths and an index
+    """
+    parent = os.path.dirname(path) or "."
+    os.makedirs(parent, exist_ok=True)
+    # unique per writer, so concurrent conversions of one dataset do not collide
+    tmp_path = tempfile.mkdtemp(prefix=f".{os.path.basename(path)}-", dir=parent)
+    try:
+        files = {
+            k: open(os.path.join(tmp_path, f"{k}.bin"), "wb") for k in EPISODE_KEYS
+        }
+        index, lengths = {}, []
+        for episode in episodes:
+            for key, x in zip(EPISODE_KEYS, episode):
+                x = np.ascontiguousarray(x)
+                files[key].write(x.tobytes())
+                index[key] = {"dtype": x.dtype.str, "dim": x.shape[-1]}
+            lengths.append(len(episode[0]))
+
+        for key, f in files.items():
+            f.write(np.zeros(index[key]["dim"], dtype=index[key]["dtype"]).tobytes())
+            f.close()
+        index["num_steps"] = sum(lengths)
+        np.save(
+            os.path.join(tmp_path, "lengths.npy"), np.array(lengths, dtype=np.int64)
+        )
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump(index, f)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    # a partly written directory is never picked up
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process finished the same conversion first, keep its entry
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, "index.json")):
+            raise
+
+
+def read_episodes(path: str) -> tuple[dict, torch.Tensor]:
+    """
+    Zero-copy tensors over the memory-mapped files of write_episodes. Pages
+    are read from disk on first access.
+    """
+    index_path = os.path.join(path, "index.json")
+    with open(index_path) as f:
+        index = json.load(f)
+    # the mtime marks the last use for cleanup_cache
+    os.utime(index_path)
+    data = {}
+    for key in EPISODE_KEYS:
+        # copy-on-write keeps the files read-only and the tensors writable
+        buffer = np.memmap(
+            os.path.join(path, f"{key}.bin"),
+            dtype=np.dtype(index[key]["dtype"]),
+            mode="c",
+            shape=(index["num_steps"] + 1, index[key]["dim"]),
+        )
+        data[key] = torch.from_numpy(buffer)
+    lengths = torch.from_numpy(np.load(os.path.join(path, "lengths.npy")))
+    return data, lengths
+
+
+def cache_key(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def cleanup_cache(cache_dir: str, max_bytes: float, keep: str | None = None):
+    """
+    Remove the least recently used cache entries until the cache fits in
+    max_bytes, never the entry in keep
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        index_path = os.path.join(path, "index.json")
+        # skip unfinished conversions
+        if not os.path.exists(index_path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.path.getmtime(index_path), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path)
+        total -= size
+        log.info(f"Removed cached dataset {path}")
+
+
+def window_rows(offsets, lengths, episodes, starts, window: int, T_cond: int):
+    """
+    Rows of the ragged buffers that make up (B,) windows, as (B, window).
+    Starts count the T_cond - 1 padding steps, padding and steps past the end
+    of an episode map to the trailing zero row.
+    """
+    steps = torch.arange(window, device=starts.device) - (T_cond - 1)
+    steps = starts.unsqueeze(-1) + steps
+    valid = (steps >= 0) & (steps < lengths[episodes].unsqueeze(-1))
+    return torch.where(valid, offsets[episodes].unsqueeze(-1) + steps, -1)
+
+
 class SlicerWrapper(Dataset):
     def __init__(self, dataset: Subset, T_cond: int, T: int):
         self.dataset = dataset
         self.T_cond = T_cond
         self.T = T
-        self.slices = self._create_slices(T_cond, T)
-
-    def _create_slices(self, T_cond, T):
-        slices = []
+        self.window = T_cond + T - 1
+        self.episodes, self.starts = self._create_slices(T_cond, T)
+
+    def _create_slices(self, T_cond, T) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Episode and start of every window as int32 tensors, from the episode
+        lengths without visiting the episodes
+        """
         window = T_cond + T - 1
-        for i in range(len(self.dataset)):
-            length = self.dataset[i]["length"]
-            if length >= window:
-                slices += [
-                    (i, start, start + window) for start in range(length - window + 1)
-                ]
-            else:
-                # add a padded slice
-                slices += [(i, start, start + window) for start in range(length - 1)]
-        return slices
+        expert_dataset = self.dataset.dataset
+        indices = torch.as_tensor(self.dataset.indices, device=expert_dataset.device)
+        lengths = (expert_dataset.lengths[indices] + T_cond - 1).cpu()
+
+        # full windows, or padded windows for episodes shorter than one
+        num_starts = torch.where(lengths >= window, lengths - window + 1, lengths - 1)
+        num_starts = num_starts.clamp(min=0)
+        episodes = torch.repeat_interleave(torch.arange(len(lengths)), num_starts)
+        # position of each window within its episode
+        offsets = torch.cumsum(num_starts, dim=0) - num_starts
+        starts = torch.arange(len(episodes)) - offsets[episodes]
+        return episodes.int(), starts.int()
 
     def __len__(self):
-        return len(self.slices)
+        return len(self.episodes)
 
     def __getitem__(self, idx):
-        i, start, end = self.slices[idx]
-        x = self.dataset[i]
-        return {k: v[start:end] for k, v in x.items() if k != "length"}
+        # read the window directly, skipping the length lookup of the episode
+        expert_dataset = self.dataset.dataset
+        episode = self.dataset.indices[self.episodes[idx]]
+        episodes = torch.tensor([episode], device=expert_dataset.device)
+        starts = self.starts[idx : idx + 1].long().to(expert_dataset.device)
+        window = expert_dataset.get_windows(episodes, starts, self.window)
+        return {k: v[0] for k, v in window.items()}
+
+
+class WindowLoader:
+    """
+    Drop-in for a shuffling DataLoader over a SlicerWrapper. Each batch of
+    windows is gathered from the episode buffers with one indexing op, without
+    per-window Python calls or collation, then moved to the device.
+
+    buffers: (data, offsets, lengths) of the full dataset, shared between
+    loaders. Gathering runs wherever they live. Batches gathered on the host for
+    a GPU go through pinned staging buffers, so their copies run asynchronously.
+    """
+
+    def __init__(
+        self,
+        dataset: SlicerWrapper,
+        batch_size: int,
+        shuffle: bool,
+        buffers: tuple[dict, torch.Tensor, torch.Tensor],
+        device="cpu",
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+
+        self.T_cond = dataset.dataset.dataset.T_cond
+        self.window = dataset.window
+        self.data, self.offsets, self.lengths = buffers
+        # episode of each window in the full dataset
+        indices = torch.as_tensor(dataset.dataset.indices)
+        self.episodes = indices[dataset.episodes.long()].to(self.offsets.device)
+        self.starts = dataset.starts.long().to(self.offsets.device)
+
+        # two staging buffers, one is filled while the other is being copied
+        self.staging = None
+        if self.offsets.device.type == "cpu" and torch.device(device).type == "cuda":
+            rows = batch_size * self.window
+            self.staging = [
+                {
+                    k: torch.empty((rows, v.shape[-1]), dtype=v.dtype).pin_memory()
+                    for k, v in self.data.items()
+                }
+                for _ in range(2)
+            ]
+            self.copied = [None, None]
+
+    def __len__(self):
+        return math.ceil(len(self.episodes) / self.batch_size)
+
+    def __iter__(self):
+        num_windows = len(self.episodes)
+        if self.shuffle:
+            order = torch.randperm(num_windows, device=self.offsets.device)
+        else:
+            order = torch.arange(num_windows, device=self.offsets.device)
+        for i, batch in enumerate(order.split(self.batch_size)):
+            rows = window_rows(
+                self.offsets,
+                self.lengths,
+                self.episodes[batch],
+                self.starts[batch],
+                self.window,
+                self.T_cond,
+            )
+            if self.staging is not None:
+                yield self.transfer(rows, i % 2)
+            else:
+                yield {k: v[rows].to(self.device) for k, v in self.data.items()}
+
+    def transfer(self, rows: torch.Tensor, slot: int) -> dict:
+        """
+        Gather host rows into a pinned staging buffer and start its copy to the
+        device. The buffer is only refilled once that copy has finished.
+        """
+        if self.copied[slot] is not None:
+            self.copied[slot].synchronize()
+        # index_select takes no negative indices, -1 is the trailing zero row
+        flat = rows.flatten()
+        flat = torch.where(flat < 0, len(self.data["obs"]) - 1, flat)
+        batch = {}
+        for k, v in self.data.items():
+            staged = self.staging[slot][k][: len(flat)]
+            torch.index_select(v, 0, flat, out=staged)
+            staged = staged.view(*rows.shape, -1)
+            batch[k] = staged.to(self.device, non_blocking=True)
+        self.copied[slot] = torch.cuda.Event()
+        self.copied[slot].record()
+        return batch
 
 
 def get_dataloaders(
@@ -225,13 +578,43 @@ def get_dataloaders(
     train_batch_size: int,
     test_batch_size: int,
     num_workers: int,
+    resident: bool = False,
+    device: str = "cpu",
+    resident_device: str | None = None,
+    mmap_dir: str | None = None,
+    cache_dir: str | None = DEFAULT_CACHE_DIR,
+    cache_max_gb: float = 20.0,
 ):
     # Build the datasets
-    dataset = ExpertDataset(data_directory, T_cond, task_name)
+    dataset = ExpertDataset(
+        data_directory,
+        T_cond,
+        task_name,
+        mmap_dir=mmap_dir,
+        cache_dir=cache_dir,
+        cache_max_gb=cache_max_gb,
+    )
     train, val = random_split(dataset, [train_fraction, 1 - train_fraction])
     train_set = SlicerWrapper(train, T_cond, T)
     test_set = SlicerWrapper(val, T_cond, T)
 
+    # gather whole batches with one indexing op
+    if resident:
+        # one copy of the buffers for both loaders, on the training device
+        # unless resident_device keeps them elsewhere, e.g. on the host when
+        # they do not fit
+        buffer_device = device if resident_device is None else resident_device
+        buffers = (
+            {k: v.to(buffer_device) for k, v in dataset.data.items()},
+            dataset.offsets.to(buffer_device),
+            dataset.lengths.to(buffer_device),
+        )
+        train_dataloader = WindowLoader(
+            train_set, train_batch_size, True, buffers, device
+        )
+        test_dataloader = WindowLoader(test_set, test_batch_size, True, buffers, device)
+        return train_dataloader, test_dataloader
+
     # Build the dataloaders
     train_dataloader = DataLoader(
         train_set,
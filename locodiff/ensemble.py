@@ -0,0 +1,129 @@
+import copy
+import logging
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from locodiff.utils import CFGWrapper
+
+log = logging.getLogger(__name__)
+
+
+class EnsembleModel(nn.Module):
+    """
+    N models of one architecture with stacked parameters, evaluated in a single
+    vmapped call. Inputs hold the batches of all members back to back, (N * B, ...).
+    """
+
+    def __init__(self, models: list[nn.Module]):
+        super().__init__()
+        self.num_models = len(models)
+        self.stacked_params, self.stacked_buffers = stack_module_state(models)
+        # stateless copy of the architecture, the weights come from the stacks
+        self.base = copy.deepcopy(models[0]).to("meta").eval()
+
+    def forward(self, x: torch.Tensor, sigma: torch.Tensor, data: dict):
+        def split(v):
+            return v.view(self.num_models, -1, *v.shape[1:])
+
+        data = {k: split(v) for k, v in data.items() if torch.is_tensor(v)}
+
+        def call(params, buffers, x, sigma, data):
+            return functional_call(self.base, (params, buffers), (x, sigma, data))
+
+        out = vmap(call, randomness="different")(
+            self.stacked_params, self.stacked_buffers, split(x), split(sigma), data
+        )
+        return out.flatten(0, 1)
+
+
+class PolicyEnsemble:
+    """
+    Samples and tests several weight sets of a policy's model in one pass,
+    e.g. checkpoints, seeds or EMA variants
+    """
+
+    def __init__(self, policy, state_dicts: list[dict]):
+        self.policy = policy
+        self.num_models = len(state_dicts)
+        base = policy.model
+        if isinstance(base, CFGWrapper):
+            base = base.model
+
+        models = []
+        for state_dict in state_dicts:
+            model = copy.deepcopy(base)
+            model.load_state_dict(state_dict)
+            models.append(model.eval())
+        self.model = EnsembleModel(models).eval()
+
+        # keep classifier-free guidance of the policy
+        if isinstance(policy.model, CFGWrapper):
+            self.model = CFGWrapper(
+                self.model, policy.model.cond_lambda, policy.model.cond_mask_prob
+            ).eval()
+
+    @classmethod
+    def from_checkpoints(cls, policy, paths: list[str]) -> "PolicyEnsemble":
+        prefix = "model.model." if isinstance(policy.model, CFGWrapper) else "model."
+        state_dicts = []
+        for path in paths:
+            checkpoint = torch.load(path, map_location=policy.device)
+            state_dicts.append(
+                {
+                    k[len(prefix) :]: v
+                    for k, v in checkpoint["model_state_dict"].items()
+                    if k.startswith(prefix)
+                }
+            )
+        log.info(f"Loaded an ensemble of {len(paths)} checkpoints")
+        return cls(policy, state_dicts)
+
+    @torch.no_grad()
+    def forward(self, data: dict) -> torch.Tensor:
+        """
+        Plans of every member for the same processed batch, (N, B, T, input_dim)
+        """
+        N = self.num_models
+        data = {
+            k: v.repeat(N, *[1] * (v.dim() - 1))
+            for k, v in data.items()
+            if torch.is_tensor(v)
+        }
+        # run the policy's sampling loop with the ensemble as its model
+        model = self.policy.model
+        self.policy.model = self.model
+        try:
+            x = self.policy(data)
+        finally:
+            self.policy.model = model
+        return x.view(N, -1, *x.shape[1:])
+
+    @torch.no_grad()
+    def test(self, data: dict) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Per-member mse, obs mse and action mse on a batch, each of shape (N,)
+        """
+        policy = self.policy
+        data = policy.process(data)
+        x = self.forward(data)
+        input = policy.normalizer.inverse_scale_output(data["input"])
+        loss = (x - input) ** 2
+        obs_loss = loss[..., policy.action_dim :].mean(dim=(1, 2, 3))
+        action_loss = loss[..., : policy.action_dim].mean(dim=(1, 2, 3))
+        return loss.mean(dim=(1, 2, 3)), obs_loss, action_loss
+
+    def evaluate(self, data_loader) -> list[dict]:
+        """
+        Per-member test metrics from a single pass over the loader
+        """
+        totals = torch.zeros(3, self.num_models, device=self.policy.device)
+        num_batches = 0
+        for batch in data_loader:
+            totals += torch.stack(self.test(batch))
+            num_batches += 1
+        totals = (totals / num_batches).tolist()
+        return [
+            {"model": i, "mse": mse, "obs_mse": obs_mse, "act_mse": act_mse}
+            for i, (mse, obs_mse, act_mse) in enumerate(zip(*totals))
+        ]
@@ -0,0 +1,141 @@
+import logging
+import math
+import torch
+import torch.nn as nn
+
+log = logging.getLogger(__name__)
+
+
+class LoRALinear(nn.Module):
+    """
+    Frozen linear layer plus a trainable low-rank update, base(x) + s * B(A(x))
+    """
+
+    def __init__(self, base: nn.Linear, rank: int, alpha: float):
+        super().__init__()
+        rank = min(rank, base.in_features, base.out_features)
+        self.base = base
+        self.lora_down = nn.Linear(base.in_features, rank, bias=False)
+        self.lora_up = nn.Linear(rank, base.out_features, bias=False)
+        self.scale = alpha / rank
+        # the update starts at zero, so the adapted model equals the base model
+        nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_up.weight)
+        self.to(base.weight.device)
+
+    def forward(self, x):
+        return self.base(x) + self.scale * self.lora_up(self.lora_down(x))
+
+    @torch.no_grad()
+    def merge(self) -> nn.Linear:
+        self.base.weight += self.scale * self.lora_up.weight @ self.lora_down.weight
+        return self.base
+
+
+class LoRAConv1d(nn.Module):
+    """
+    Frozen conv plus a trainable low-rank update: a rank-channel conv with the
+    base kernel, followed by a 1x1 conv back to the output channels
+    """
+
+    def __init__(self, base: nn.Conv1d, rank: int, alpha: float):
+        super().__init__()
+        if base.groups != 1:
+            raise ValueError("LoRA only supports ungrouped convolutions")
+        rank = min(rank, base.in_channels, base.out_channels)
+        self.base = base
+        self.lora_down = nn.Conv1d(
+            base.in_channels,
+            rank,
+            base.kernel_size,
+            stride=base.stride,
+            padding=base.padding,
+            dilation=base.dilation,
+            bias=False,
+        )
+        self.lora_up = nn.Conv1d(rank, base.out_channels, 1, bias=False)
+        self.scale = alpha / rank
+        nn.init.kaiming_uniform_(self.lora_down.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.lora_up.weight)
+        self.to(base.weight.device)
+
+    def forward(self, x):
+        return self.base(x) + self.scale * self.lora_up(self.lora_down(x))
+
+    @torch.no_grad()
+    def merge(self) -> nn.Conv1d:
+        up = self.lora_up.weight.squeeze(-1)
+        update = torch.einsum("or,rik->oik", up, self.lora_down.weight)
+        self.base.weight += self.scale * update
+        return self.base
+
+
+def inject_lora(
+    model: nn.Module,
+    rank: int,
+    alpha: float | None = None,
+    targets: list[str] | None = None,
+) -> list[str]:
+    """
+    Freeze the model and wrap its layers with LoRA adapters, in place.
+
+    targets are attribute names of the layers to adapt, e.g. ["qkv", "out_proj"];
+    by default every Conv1d and Linear is adapted, except scalar input
+    projections. Returns the names of the adapted layers.
+    """
+    alpha = rank if alpha is None else alpha
+    model.requires_grad_(False)
+
+    names = []
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (LoRALinear, LoRAConv1d)):
+            raise ValueError("The model already has LoRA adapters")
+        if not isinstance(module, (nn.Linear, nn.Conv1d)):
+            continue
+        parent_name, _, attr = name.rpartition(".")
+        if targets is not None and attr not in targets:
+            continue
+        # a low-rank update of a scalar input is a full update
+        if targets is None and getattr(module, "in_features", None) == 1:
+            continue
+
+        wrapper = LoRALinear if isinstance(module, nn.Linear) else LoRAConv1d
+        setattr(model.get_submodule(parent_name), attr, wrapper(module, rank, alpha))
+        names.append(name)
+
+    num_params = sum(p.numel() for p in lora_parameters(model))
+    log.info(f"Added LoRA adapters to {len(names)} layers, {num_params:e} parameters")
+    return names
+
+
+def lora_parameters(model: nn.Module) -> list[nn.Parameter]:
+    return [p for n, p in model.named_parameters() if "lora_" in n]
+
+
+def lora_state_dict(model: nn.Module) -> dict:
+    """
+    Adapter weights only, a small fraction of the full state dict
+    """
+    return {k: v for k, v in model.state_dict().items() if "lora_" in k}
+
+
+def load_lora_state_dict(model: nn.Module, state_dict: dict):
+    """
+    Swap in the adapters of another task, the base weights are untouched
+    """
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing = [k for k in missing if "lora_" in k]
+    if missing or unexpected:
+        raise RuntimeError(
+            f"Adapter mismatch, missing: {missing}, unexpected: {unexpected}"
+        )
+
+
+def merge_lora(model: nn.Module):
+    """
+    Fold every adapter into its base layer, in place, for adapter-free inference
+    """
+    for name, module in list(model.named_modules()):
+        if isinstance(module, (LoRALinear, LoRAConv1d)):
+            parent_name, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), attr, module.merge())
@@ -0,0 +1,277 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+class SelfAttention(nn.Module):
+    """
+    Multi-head self-attention with a fused QKV projection. With a window, each
+    token only attends to tokens within `window` (dilated) steps, plus the first
+    num_global tokens of the sequence, which attend to everything.
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        nhead: int,
+        dropout: float,
+        window: int | None = None,
+        dilation: int = 1,
+        num_global: int = 0,
+    ):
+        super().__init__()
+        self.nhead = nhead
+        self.dropout = dropout
+        self.window = window
+        self.dilation = dilation
+        self.num_global = num_global
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+    def forward(self, x, is_causal=False):
+        B, T, C = x.shape
+        # (3, B, nhead, T, head_dim)
+        qkv = self.qkv(x).view(B, T, 3, self.nhead, C // self.nhead)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4)
+        dropout = self.dropout if self.training else 0.0
+        if self.window is None:
+            y = F.scaled_dot_product_attention(
+                q, k, v, dropout_p=dropout, is_causal=is_causal
+            )
+        else:
+            y = self.windowed_attention(q, k, v, dropout, is_causal)
+        y = y.transpose(1, 2).reshape(B, T, C)
+        return self.out_proj(y)
+
+    def windowed_attention(self, q, k, v, dropout, is_causal):
+        G = self.num_global
+        if G == 0:
+            return local_attention(
+                q, k, v, self.window, self.dilation, is_causal, dropout_p=dropout
+            )
+
+        # global tokens attend to the whole sequence
+        y_global = F.scaled_dot_product_attention(q[:, :, :G], k, v, dropout_p=dropout)
+        # local tokens attend to their window and the global tokens
+        global_kv = (k[:, :, :G], v[:, :, :G])
+        y_local = local_attention(
+            q[:, :, G:],
+            k[:, :, G:],
+            v[:, :, G:],
+            self.window,
+            self.dilation,
+            is_causal,
+            global_kv,
+            dropout,
+        )
+        return torch.cat([y_global, y_local], dim=2)
+
+
+class CrossAttention(nn.Module):
+    """
+    Multi-head cross-attention with a fused KV projection of the memory
+    """
+
+    def __init__(self, d_model: int, nhead: int, dropout: float):
+        super().__init__()
+        self.nhead = nhead
+        self.dropout = dropout
+        self.q_proj = nn.Linear(d_model, d_model)
+        self.kv_proj = nn.Linear(d_model, 2 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+
+    def project_kv(self, memory):
+        """
+        memory: (B, S, C) -> keys and values stacked as (2, B, nhead, S, head_dim)
+        """
+        B, S, C = memory.shape
+        kv = self.kv_proj(memory).view(B, S, 2, self.nhead, C // self.nhead)
+        return kv.permute(2, 0, 3, 1, 4)
+
+    def forward(self, x, memory=None, kv=None):
+        B, T, C = x.shape
+        q = self.q_proj(x).view(B, T, self.nhead, -1).transpose(1, 2)
+        # keys and values can be precomputed when the memory is constant
+        if kv is None:
+            kv = self.project_kv(memory)
+        k, v = kv
+        dropout = self.dropout if self.training else 0.0
+        y = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout)
+        y = y.transpose(1, 2).reshape(B, T, C)
+        return self.out_proj(y)
+
+
+class DecoderBlock(nn.Module):
+    """
+    Pre-norm transformer decoder layer built on scaled_dot_product_attention.
+    Computes the same function as nn.TransformerDecoderLayer with
+    norm_first=True and a gelu activation. With adaln, each sublayer is instead
+    modulated by a conditioning vector (adaLN-Zero, https://arxiv.org/abs/2212.09748).
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        nhead: int,
+        dim_feedforward: int,
+        dropout: float,
+        adaln: bool = False,
+        window: int | None = None,
+        dilation: int = 1,
+        num_global: int = 0,
+    ):
+        super().__init__()
+        self.norm1 = nn.LayerNorm(d_model)
+        self.self_attn = SelfAttention(
+            d_model, nhead, dropout, window, dilation, num_global
+        )
+        self.norm2 = nn.LayerNorm(d_model)
+        self.cross_attn = CrossAttention(d_model, nhead, dropout)
+        self.norm3 = nn.LayerNorm(d_model)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.dropout = nn.Dropout(dropout)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+        self.dropout3 = nn.Dropout(dropout)
+        # shift, scale and gate for each sublayer
+        self.modulation = (
+            nn.Sequential(nn.SiLU(), nn.Linear(d_model, 9 * d_model)) if adaln else None
+        )
+        # recompute activations in the backward pass instead of storing them
+        self.checkpoint = False
+
+    def forward(self, x, memory=None, kv=None, mod=None, is_causal=False):
+        """
+        x: (B, T, d_model)
+        memory: (B, S, d_model) or kv: precomputed cross-attention keys/values,
+            cross-attention is skipped if both are None
+        mod: (B, d_model) adaLN conditioning
+        """
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(
+                self._forward, x, memory, kv, mod, is_causal, use_reentrant=False
+            )
+        return self._forward(x, memory, kv, mod, is_causal)
+
+    def _forward(self, x, memory, kv, mod, is_causal):
+        has_memory = memory is not None or kv is not None
+        if self.modulation is None:
+            x = x + self.dropout1(self.self_attn(self.norm1(x), is_causal=is_causal))
+            if has_memory:
+                x = x + self.dropout2(self.cross_attn(self.norm2(x), memory, kv))
+            x = x + self.dropout3(self.ff_block(self.norm3(x)))
+            return x
+
+        params = self.modulation(mod).unsqueeze(1).chunk(9, dim=-1)
+        shift1, scale1, gate1, shift2, scale2, gate2, shift3, scale3, gate3 = params
+        h = modulate(self.norm1(x), shift1, scale1)
+        x = x + gate1 * self.dropout1(self.self_attn(h, is_causal=is_causal))
+        if has_memory:
+            h = modulate(self.norm2(x), shift2, scale2)
+            x = x + gate2 * self.dropout2(self.cross_attn(h, memory, kv))
+        h = modulate(self.norm3(x), shift3, scale3)
+        x = x + gate3 * self.dropout3(self.ff_block(h))
+        return x
+
+    def ff_block(self, x):
+        return self.linear2(self.dropout(F.gelu(self.linear1(x))))
+
+
+def local_attention(
+    q, k, v, window, dilation=1, causal=False, global_kv=None, dropout_p=0.0
+):
+    """
+    Sliding-window attention with O(T * window) memory. Each query attends to
+    keys at most `window` steps away within its residue class modulo `dilation`,
+    and to the optional global keys/values.
+
+    q, k, v: (B, H, T, D)
+    global_kv: tuple of (B, H, G, D) keys and values
+    """
+    B, H, T, D = q.shape
+    w, r = window, dilation
+    # pad so the sequence splits into r interleaved groups of n blocks of size w
+    n = math.ceil(T / (r * w))
+    T_pad = n * r * w
+    q, k, v = (F.pad(x, (0, 0, 0, T_pad - T)) for x in (q, k, v))
+
+    # position t = i * r + g goes to group g, index i, (B, H, r, n, w, D)
+    def to_blocks(x):
+        return x.view(B, H, T_pad // r, r, D).transpose(2, 3).reshape(B, H, r, n, w, D)
+
+    q, k, v = to_blocks(q), to_blocks(k), to_blocks(v)
+
+    # keys of each block are its previous, own and next block, (B, H, r, n, 3w, D)
+    def with_neighbours(x):
+        x = F.pad(x, (0, 0, 0, 0, 1, 1))
+        return torch.cat([x[:, :, :, :-2], x[:, :, :, 1:-1], x[:, :, :, 2:]], dim=4)
+
+    k, v = with_neighbours(k), with_neighbours(v)
+
+    # query a of block b sits at b * w + a, key c at (b - 1) * w + c
+    a = torch.arange(w, device=q.device).view(w, 1)
+    c = torch.arange(3 * w, device=q.device).view(1, 3 * w)
+    dist = w + a - c
+    mask = dist.abs() <= w
+    if causal:
+        mask = mask & (dist >= 0)
+    # mask padded keys, padded queries keep them so no row is fully masked
+    g = torch.arange(r, device=q.device).view(r, 1, 1, 1)
+    b = torch.arange(n, device=q.device).view(1, n, 1, 1)
+    key_idx = (b - 1) * w + c
+    key_valid = (key_idx >= 0) & (key_idx * r + g < T)
+    query_pad = (b * w + a) * r + g >= T
+    mask = mask & (key_valid | query_pad)
+
+    if global_kv is not None:
+        G = global_kv[0].shape[2]
+        k_g, v_g = (
+            x.view(B, H, 1, 1, G, D).expand(-1, -1, r, n, -1, -1) for x in global_kv
+        )
+        k, v = torch.cat([k, k_g], dim=4), torch.cat([v, v_g], dim=4)
+        mask = torch.cat([mask, mask.new_ones(r, n, w, G)], dim=-1)
+
+    # flatten blocks into the head dimension for the 4D attention kernels
+    num_keys = k.shape[4]
+    q = q.reshape(B, H * r * n, w, D)
+    k = k.reshape(B, H * r * n, num_keys, D)
+    v = v.reshape(B, H * r * n, num_keys, D)
+    mask = mask.expand(H, r, n, w, num_keys).reshape(H * r * n, w, num_keys)
+    y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+    # back to (B, H, T, D)
+    y = y.view(B, H, r, T_pad // r, D).transpose(2, 3).reshape(B, H, T_pad, D)
+    return y[:, :, :T]
+
+
+def modulate(x, shift, scale):
+    return x * (1 + scale) + shift
+
+
+def convert_decoder_state_dict(state_dict: dict, prefix: str, d_model: int):
+    """
+    Map nn.TransformerDecoder weights stored under {prefix}decoder.layers.* onto
+    DecoderBlock weights under {prefix}blocks.*, in place
+    """
+    # the causal mask used to be a registered buffer
+    state_dict.pop(prefix + "mask", None)
+
+    old_prefix = prefix + "decoder.layers."
+    for key in [k for k in state_dict if k.startswith(old_prefix)]:
+        value = state_dict.pop(key)
+        layer, name = key[len(old_prefix) :].split(".", 1)
+        new_prefix = f"{prefix}blocks.{layer}."
+        if name.startswith("self_attn.in_proj_"):
+            param = name.rsplit("_", 1)[-1]
+            state_dict[new_prefix + "self_attn.qkv." + param] = value
+        elif name.startswith("multihead_attn.in_proj_"):
+            param = name.rsplit("_", 1)[-1]
+            state_dict[new_prefix + "cross_attn.q_proj." + param] = value[:d_model]
+            state_dict[new_prefix + "cross_attn.kv_proj." + param] = value[d_model:]
+        elif name.startswith("multihead_attn."):
+            name = name.replace("multihead_attn.", "cross_attn.", 1)
+            state_dict[new_prefix + name] = value
+        else:
+            state_dict[new_prefix + name] = value
@@ -0,0 +1,147 @@
+import logging
+import torch
+import torch.nn as nn
+from torch.optim.adamw import AdamW
+
+log = logging.getLogger(__name__)
+
+
+class TrajectoryVAE(nn.Module):
+    """
+    MLP VAE over flattened trajectory windows, used as the latent space for
+    latent diffusion. Follows the structure and GECO beta control of vae.vae.VAE.
+    """
+
+    def __init__(
+        self,
+        input_dim: int,
+        T: int,
+        latent_len: int,
+        latent_dim: int,
+        hidden_dims: list,
+        learning_rate: float,
+        num_iters: int,
+        goal=0.01,
+        beta_min=1e-6,
+        beta_max=10,
+        alpha=0.95,
+        geco_lr=1e-5,
+        speedup=None,
+        device="cpu",
+    ):
+        super().__init__()
+        flat_dim = T * input_dim
+        flat_latent_dim = latent_len * latent_dim
+
+        # encoder
+        encoder_layers = []
+        encoder_layers.append(nn.Linear(flat_dim, hidden_dims[0]))
+        encoder_layers.append(nn.ELU())
+
+        for i in range(1, len(hidden_dims)):
+            encoder_layers.append(nn.Linear(hidden_dims[i - 1], hidden_dims[i]))
+            encoder_layers.append(nn.ELU())
+
+        encoder_layers.append(nn.Linear(hidden_dims[-1], 2 * flat_latent_dim))
+        self.encoder = nn.Sequential(*encoder_layers)
+
+        # decoder
+        decoder_layers = []
+        decoder_layers.append(nn.Linear(flat_latent_dim, hidden_dims[-1]))
+        decoder_layers.append(nn.ELU())
+
+        for i in range(len(hidden_dims) - 1, 0, -1):
+            decoder_layers.append(nn.Linear(hidden_dims[i], hidden_dims[i - 1]))
+            decoder_layers.append(nn.ELU())
+
+        decoder_layers.append(nn.Linear(hidden_dims[0], flat_dim))
+        self.decoder = nn.Sequential(*decoder_layers)
+
+        self.optimizer = AdamW(self.parameters(), lr=learning_rate)
+        self.input_dim = input_dim
+        self.T = T
+        self.latent_len = latent_len
+        self.latent_dim = latent_dim
+        self.num_iters = num_iters
+
+        # geco
+        self.goal = goal
+        self.beta = 1.0
+        self.beta_min = beta_min
+        self.beta_max = beta_max
+        self.alpha = alpha
+        self.geco_lr = geco_lr
+        self.speedup = speedup
+        self.err_ema = None
+
+        # persisted so resumed runs skip autoencoder training
+        self.register_buffer("trained", torch.tensor(False))
+
+        self.device = device
+        self.to(device)
+
+        log.info(f"Autoencoder parameters: {sum(p.numel() for p in self.parameters()):e}")
+
+    def encode(self, x):
+        """
+        x: (B, T, input_dim) -> z, mu, logvar: (B, latent_len, latent_dim)
+        """
+        x = self.encoder(x.reshape(x.shape[0], -1))
+        mu, logvar = torch.chunk(x, 2, dim=-1)
+        std = torch.exp(0.5 * logvar)
+        z = mu + std * torch.randn_like(mu)
+        shape = (x.shape[0], self.latent_len, self.latent_dim)
+        return z.view(shape), mu.view(shape), logvar.view(shape)
+
+    def decode(self, z):
+        """
+        z: (B, latent_len, latent_dim) -> x: (B, T, input_dim)
+        """
+        x = self.decoder(z.reshape(z.shape[0], -1))
+        return x.view(z.shape[0], self.T, self.input_dim)
+
+    def forward(self, x):
+        z, mu, logvar = self.encode(x)
+        x_hat = self.decode(z)
+        return x_hat, mu, logvar
+
+    ##
+    # Training
+    ##
+
+    def update(self, x):
+        x_hat, mu, logvar = self(x)
+
+        recon_loss = torch.mean((x - x_hat) ** 2)
+        kl_loss = -0.5 * torch.mean(1 + logvar - mu**2 - logvar.exp())
+
+        self.geco_step(recon_loss)
+
+        loss = recon_loss + self.beta * kl_loss
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+
+        return loss.item(), recon_loss.item(), kl_loss.item()
+
+    def geco_step(self, err):
+        with torch.no_grad():
+            # update ema
+            if self.err_ema is None:
+                self.err_ema = err
+            else:
+                self.err_ema = (1.0 - self.alpha) * err + self.alpha * self.err_ema
+
+            # update beta
+            constraint = self.goal - self.err_ema
+            if self.speedup is not None and constraint.item() > 0:
+                factor = torch.exp(self.speedup * self.geco_lr * constraint)
+            else:
+                factor = torch.exp(self.geco_lr * constraint)
+            self.beta = (factor * self.beta).clamp(self.beta_min, self.beta_max)
+
+    def freeze(self):
+        self.requires_grad_(False)
+        self.eval()
+        self.trained.fill_(True)
@@ -1,23 +1,56 @@
+import logging
 import torch
 import torch.nn as nn
 
-from .utils import SinusoidalPosEmb
+from locodiff.utils import fold_linear_input
+
+log = logging.getLogger(__name__)
 
 
 class DiffusionMLPSieve(nn.Module):
-    def __init__(self, obs_dim, act_dim, T, T_cond, n_emb, n_hidden):
-        super(DiffusionMLPSieve, self).__init__()
-        self.T = T
-        self.cond_mask_prob = 0.1
+    """
+    Flat MLP denoiser over the whole trajectory window. Every hidden layer sees
+    the noised input and sigma again through sieve skip connections.
+    """
+
+    def __init__(
+        self,
+        obs_dim: int,
+        act_dim: int,
+        T: int,
+        T_cond: int,
+        n_emb: int,
+        n_hidden: int,
+        cond_mask_prob: float,
+        weight_decay: float,
+        inpaint: bool,
+        device: str,
+        input_dim: int | None = None,
+    ):
+        super().__init__()
+        if input_dim is None:
+            input_dim = obs_dim + act_dim
+        self.obs_dim = obs_dim
+        self.cond_mask_prob = cond_mask_prob
+        self.weight_decay = weight_decay
+        self.inpaint = inpaint
+        self.device = device
+
+        # change dims depending on if we're inpainting the obs
+        self.input_len = T + T_cond - 1 if inpaint else T
+        self.input_dim = input_dim
+        # returns, plus obs history and goal when they are not inpainted
+        num_cond = 1 if inpaint else T_cond + 2
+        flat_dim = self.input_len * input_dim
 
         # embedding
         self.obs_emb = nn.Sequential(
-            nn.Linear(obs_dim + 1, n_emb),
+            nn.Linear(obs_dim, n_emb),
             nn.LeakyReLU(),
             nn.Linear(n_emb, n_emb),
         )
-        self.action_emb = nn.Sequential(
-            nn.Linear(act_dim, n_emb),
+        self.input_emb = nn.Sequential(
+            nn.Linear(input_dim, n_emb),
             nn.LeakyReLU(),
             nn.Linear(n_emb, n_emb),
         )
@@ -27,16 +60,17 @@ class DiffusionMLPSieve(nn.Module):
             nn.Linear(n_emb, n_emb),
         )
         self.sigma_emb = nn.Sequential(
-            SinusoidalPosEmb(n_emb),
+            nn.Linear(1, n_emb),
+            nn.LeakyReLU(),
             nn.Linear(n_emb, n_emb),
         )
 
         # decoder
         dims = [
-            ((T + T_cond + 2) * n_emb, n_hidden),
-            (n_hidden + T * (act_dim) + 1, n_hidden),
-            (n_hidden + T * (act_dim) + 1, n_hidden),
-            (n_hidden + T * (act_dim) + 1, T * (act_dim)),
+            ((self.input_len + num_cond + 1) * n_emb, n_hidden),
+            (n_hidden + flat_dim + 1, n_hidden),
+            (n_hidden + flat_dim + 1, n_hidden),
+            (n_hidden + flat_dim + 1, flat_dim),
         ]
         layers = []
         for i in range(len(dims) - 1):
@@ -44,61 +78,66 @@ class DiffusionMLPSieve(nn.Module):
         layers.append(nn.Linear(*dims[-1]))
         self.model = nn.ModuleList(layers)
 
-    def get_optim_groups(self, weight_decay):
-        return [{"params": self.parameters()}]
+        self.to(device)
+
+        total_params = sum(p.numel() for p in self.get_params())
+        log.info(f"Total parameters: {total_params:e}")
+
+    def get_optim_groups(self):
+        decay, no_decay = [], []
+        for name, param in self.named_parameters():
+            # all layers are linear, only their weights are decayed
+            if name.endswith("weight"):
+                decay.append(param)
+            else:
+                no_decay.append(param)
+        return [
+            {"params": decay, "weight_decay": self.weight_decay},
+            {"params": no_decay, "weight_decay": 0.0},
+        ]
 
-    def forward(self, x, sigma, data_dict, uncond=False):
+    def forward(self, x, sigma, data_dict):
+        cond = self.get_cond(data_dict, x.shape[0])
+        return self.forward_core(x, sigma, cond)
+
+    def get_cond(self, data_dict: dict, batch_size: int) -> torch.Tensor:
+        """
+        Flatten the conditioning dict into a (B, cond_dim) tensor
+        """
+        if self.inpaint:
+            return data_dict["returns"]
+        obs = data_dict["obs"].reshape(batch_size, -1)
+        return torch.cat([obs, data_dict["goal"], data_dict["returns"]], dim=-1)
+
+    def forward_core(self, x, sigma, cond):
+        """
+        x: (B, T, input_dim)
+        sigma: (B,) preconditioned noise level
+        cond: (B, cond_dim) from get_cond
+        """
         B = x.shape[0]
-
-        obs = data_dict["obs"]
-        vel_cmd = data_dict["vel_cmd"].unsqueeze(1).expand(-1, obs.shape[1], -1)
-        obs = torch.cat([obs, vel_cmd], dim=-1)
-        obs_emb = self.obs_emb(obs)
-
-        returns = self.mask_cond(data_dict["return"], uncond)
-        return_emb = self.return_emb(returns).unsqueeze(1)
-
-        cond_emb = torch.cat([return_emb, obs_emb], dim=1)
-
-        x_emb = self.action_emb(x)
+        sigma = sigma.to(x.device).view(B, 1)
+
+        # embeddings
+        cond_emb = [self.return_emb(cond[:, -1:])]
+        if not self.inpaint:
+            # obs history and goal share the obs embedding
+            obs = cond[:, :-1].reshape(B, -1, self.obs_dim)
+            cond_emb.append(self.obs_emb(obs).reshape(B, -1))
+        x_emb = self.input_emb(x).reshape(B, -1)
         sigma_emb = self.sigma_emb(sigma)
 
         # decoder
-        cond_emb = cond_emb.reshape(B, -1)
-        x_emb = x_emb.reshape(B, -1)
         x = x.reshape(B, -1)
-        sigma = sigma.reshape(B, 1)
-        out = torch.cat([cond_emb, x_emb, sigma_emb], dim=-1)
+        out = torch.cat([*cond_emb, x_emb, sigma_emb], dim=-1)
         out = self.model[0](out)
         out = self.model[1](torch.cat([out / 1.414, x, sigma], dim=-1)) + out / 1.414
         out = self.model[2](torch.cat([out / 1.414, x, sigma], dim=-1)) + out / 1.414
         out = self.model[3](torch.cat([out, x, sigma], dim=-1))
-        return out.reshape(B, self.T, -1)
-
-    def mask_cond(self, cond, force_mask=False):
-        cond = cond.clone()
-        if force_mask:
-            cond[...] = 0
-            return cond
-        elif self.training and self.cond_mask_prob > 0:
-            mask = (torch.rand(cond.shape[0], 1) > self.cond_mask_prob).float()
-            mask = mask.expand_as(cond)
-            cond[mask == 0] = 0
-            return cond
-        else:
-            return cond
-
-
-def test():
-    n_emb = 128
-    model = DiffusionMLPSieve(36, 12, 4, 8, 128, 4 * 128)
-    x = torch.randn(4, 4, 12)
-    cond = torch.randn(4, 8, 36)
-    sigma = torch.rand(4)
-    goal = torch.randn(4, 2)
-    out = model(x, cond, sigma, goal=goal)
-    print(out.shape)
-
-
-if __name__ == "__main__":
-    test()
+        return out.reshape(B, self.input_len, self.input_dim)
+
+    def fold_input_affine(self, scale: torch.Tensor, shift: torch.Tensor):
+        fold_linear_input(self.obs_emb[0], scale, shift)
+
+    def get_params(self):
+        return self.parameters()
@@ -2,7 +2,13 @@ import logging
 import torch
 import torch.nn as nn
 
-from locodiff.utils import SinusoidalPosEmb
+from locodiff.models.attention import (
+    CrossAttention,
+    DecoderBlock,
+    SelfAttention,
+    convert_decoder_state_dict,
+)
+from locodiff.utils import SinusoidalPosEmb, fold_linear_input
 
 log = logging.getLogger(__name__)
 
@@ -23,14 +29,29 @@ class DiffusionTransformer(nn.Module):
         weight_decay: float,
         inpaint: bool,
         device: str,
+        input_dim: int | None = None,
+        causal: bool = False,
+        sigma_cond: str = "token",
+        attn_pattern: str = "full",
+        attn_window: int = 16,
+        attn_dilation: int = 2,
+        num_global_tokens: int = 4,
+        checkpoint_frac: float = 0.0,
     ):
         super().__init__()
         # variables
-        input_dim = obs_dim + act_dim
+        if input_dim is None:
+            input_dim = obs_dim + act_dim
         self.cond_mask_prob = cond_mask_prob
         self.weight_decay = weight_decay
         self.inpaint = inpaint
+        self.causal = causal
         self.device = device
+        # "token": sigma is a cross-attention memory token
+        # "adaln": sigma modulates every block and the memory is only obs/goal
+        if sigma_cond not in ("token", "adaln"):
+            raise ValueError(f"Unknown sigma conditioning {sigma_cond}")
+        self.sigma_cond = sigma_cond
 
         # embeddings
         self.input_emb = nn.Linear(input_dim, d_model)
@@ -39,32 +60,62 @@ class DiffusionTransformer(nn.Module):
 
         # change dims depending on if we're inpainting the obs
         input_len = T + T_cond - 1 if inpaint else T
-        cond_len = 1 if inpaint else T_cond + 2
+        cond_len = 0 if inpaint else T_cond + 1
+        if sigma_cond == "token":
+            cond_len += 1
 
         # dropout and position encoding
         self.pos_emb = SinusoidalPosEmb(d_model, device)(torch.arange(input_len))
         self.cond_pos_emb = SinusoidalPosEmb(d_model, device)(torch.arange(cond_len))
         self.drop = nn.Dropout(emb_dropout)
 
+        # self-attention pattern
+        # "full": every token attends to the whole sequence
+        # "sliding": tokens attend within attn_window steps
+        # "dilated": like sliding, every other layer strides by attn_dilation
+        # "local_global": sliding plus learned tokens that attend to everything
+        if attn_pattern not in ("full", "sliding", "dilated", "local_global"):
+            raise ValueError(f"Unknown attention pattern {attn_pattern}")
+        if attn_pattern == "local_global" and causal:
+            raise ValueError("Global tokens would leak future steps to causal layers")
+        self.attn_pattern = attn_pattern
+        window = None if attn_pattern == "full" else attn_window
+        self.num_global = num_global_tokens if attn_pattern == "local_global" else 0
+        if self.num_global > 0:
+            self.global_tokens = nn.Parameter(torch.zeros(1, self.num_global, d_model))
+
         # transformer
-        self.decoder = nn.TransformerDecoder(
-            nn.TransformerDecoderLayer(
-                d_model=d_model,
-                nhead=nhead,
-                dim_feedforward=4 * d_model,
-                dropout=attn_dropout,
-                activation="gelu",
-                batch_first=True,
-                norm_first=True,
-            ),
-            num_layers=num_layers,
+        self.blocks = nn.ModuleList(
+            [
+                DecoderBlock(
+                    d_model,
+                    nhead,
+                    4 * d_model,
+                    attn_dropout,
+                    adaln=sigma_cond == "adaln",
+                    window=window,
+                    dilation=attn_dilation if attn_pattern == "dilated" and i % 2 else 1,
+                    num_global=self.num_global,
+                )
+                for i in range(num_layers)
+            ]
         )
-        self.register_buffer("mask", self.generate_mask(input_len))
+        self.set_checkpointing(checkpoint_frac)
+        # load checkpoints saved with nn.TransformerDecoder
+        self._register_load_state_dict_pre_hook(self._convert_legacy_state_dict)
+        self.d_model = d_model
         # output
         self.ln_f = nn.LayerNorm(d_model)
         self.output_pred = nn.Linear(d_model, input_dim)
 
         self.apply(self._init_weights)
+        if self.num_global > 0:
+            torch.nn.init.normal_(self.global_tokens, mean=0.0, std=0.02)
+        # adaLN-Zero, every block starts as the identity
+        for block in self.blocks:
+            if block.modulation is not None:
+                torch.nn.init.zeros_(block.modulation[-1].weight)
+                torch.nn.init.zeros_(block.modulation[-1].bias)
         self.to(device)
 
         total_params = sum(p.numel() for p in self.get_params())
@@ -73,10 +124,12 @@ class DiffusionTransformer(nn.Module):
     def _init_weights(self, module):
         ignore_types = (
             nn.Dropout,
-            nn.TransformerDecoderLayer,
-            nn.TransformerDecoder,
+            DecoderBlock,
+            SelfAttention,
+            CrossAttention,
             nn.ModuleList,
             nn.Sequential,
+            nn.SiLU,
             DiffusionTransformer,
         )
         if isinstance(module, (nn.Linear, nn.Embedding)):
@@ -137,6 +190,9 @@ class DiffusionTransformer(nn.Module):
                 elif pn.endswith("weight") and isinstance(m, blacklist_weight_modules):
                     # weights of blacklist modules will NOT be weight decayed
                     no_decay.add(fpn)
+                elif pn == "global_tokens":
+                    # learned tokens are embeddings, so they are not decayed
+                    no_decay.add(fpn)
 
         # validate that we considered every parameter
         param_dict = {pn: p for pn, p in self.named_parameters()}
@@ -164,36 +220,73 @@ class DiffusionTransformer(nn.Module):
         ]
         return optim_groups
 
+    def set_checkpointing(self, frac: float):
+        """
+        Checkpoint a fraction of the decoder blocks, spread evenly over depth
+        """
+        for i, block in enumerate(self.blocks):
+            block.checkpoint = int((i + 1) * frac) > int(i * frac)
+
     def forward(self, x, sigma, data_dict):
+        # obs/goal keys and values, reused across denoising steps when cached
+        kv_cache = data_dict.get("cond_cache", None)
+        if kv_cache is None:
+            kv_cache = self.cache_cond(data_dict)
+        return self.forward_core(x, sigma, kv_cache)
+
+    def forward_core(self, x, sigma, kv_cache=None):
+        """
+        x: (B, T, input_dim)
+        sigma: (B,) preconditioned noise level
+        kv_cache: (num_layers, 2, B, nhead, S, head_dim) from cache_cond
+        """
         # embeddings
-        sigma = sigma.to(self.device)
+        sigma = sigma.to(x.device)
         sigma_emb = self.sigma_emb(sigma.view(-1, 1, 1))
-        x_emb = self.input_emb(x)
+        x_emb = self.drop(self.input_emb(x) + self.pos_emb)
 
-        # create conditioning
-        if self.inpaint:
-            cond_emb = sigma_emb
+        # sigma conditioning
+        mod = None
+        if self.sigma_cond == "adaln":
+            mod = sigma_emb.squeeze(1)
         else:
-            obs_emb = self.obs_emb(data_dict["obs"])
-            goal_emb = self.obs_emb(data_dict["goal"]).unsqueeze(1)
-            cond_emb = torch.cat([sigma_emb, obs_emb, goal_emb], dim=1)
-        # add position encoding and dropout
-        cond_emb = self.drop(cond_emb + self.cond_pos_emb)
-        x_emb = self.drop(x_emb + self.pos_emb)
+            sigma_tok = self.drop(sigma_emb + self.cond_pos_emb[:, :1])
 
         # output
-        x = self.decoder(tgt=x_emb, memory=cond_emb)
-        x = self.ln_f(x)
+        x = x_emb
+        if self.num_global > 0:
+            x = torch.cat([self.global_tokens.expand(len(x), -1, -1), x], dim=1)
+        for i, block in enumerate(self.blocks):
+            kv = None if kv_cache is None else kv_cache[i]
+            if mod is None:
+                # only the sigma token is projected every step
+                kv_sigma = block.cross_attn.project_kv(sigma_tok)
+                kv = kv_sigma if kv is None else torch.cat([kv_sigma, kv], dim=3)
+            x = block(x, kv=kv, mod=mod, is_causal=self.causal)
+        x = self.ln_f(x[:, self.num_global :])
         return self.output_pred(x)
 
-    def generate_mask(self, x):
-        mask = (torch.triu(torch.ones(x, x)) == 1).transpose(0, 1)
-        mask = (
-            mask.float()
-            .masked_fill(mask == 0, float("-inf"))
-            .masked_fill(mask == 1, float(0.0))
+    def cache_cond(self, data_dict) -> torch.Tensor | None:
+        """
+        Project the obs/goal memory to per-block cross-attention keys and values,
+        stacked as (num_layers, 2, B, nhead, S, head_dim).
+        These are constant over the denoising steps of an act() call.
+        """
+        if self.inpaint:
+            return None
+
+        obs_emb = self.obs_emb(data_dict["obs"])
+        goal_emb = self.obs_emb(data_dict["goal"]).unsqueeze(1)
+        cond_emb = torch.cat([obs_emb, goal_emb], dim=1)
+        # skip the position of the sigma token
+        offset = 1 if self.sigma_cond == "token" else 0
+        cond_emb = self.drop(cond_emb + self.cond_pos_emb[:, offset:])
+        return torch.stack(
+            [block.cross_attn.project_kv(cond_emb) for block in self.blocks]
         )
-        return mask
+
+    def _convert_legacy_state_dict(self, state_dict, prefix, *args):
+        convert_decoder_state_dict(state_dict, prefix, self.d_model)
 
     def mask_cond(self, cond, force_mask=False):
         cond = cond.clone()
@@ -208,6 +301,9 @@ class DiffusionTransformer(nn.Module):
         else:
             return cond
 
+    def fold_input_affine(self, scale: torch.Tensor, shift: torch.Tensor):
+        fold_linear_input(self.obs_emb, scale, shift)
+
     def get_params(self):
         return self.parameters()
 
@@ -1,10 +1,9 @@
 import logging
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from functools import partial
-
-import einops
-from einops.layers.torch import Rearrange
+from torch.utils.checkpoint import checkpoint
 
 from locodiff.utils import SinusoidalPosEmb
 
@@ -47,8 +46,31 @@ class Conv1dBlock(nn.Module):
             nn.Mish(),
         )
 
-    def forward(self, x):
-        return self.block(x)
+    def forward(self, x, mask=None):
+        if mask is None:
+            return self.block(x)
+        # padded steps are zeroed for the conv and left out of the norm statistics
+        conv, norm, act = self.block
+        x = conv(x * mask)
+        return act(masked_group_norm(x, norm, mask))
+
+
+def masked_group_norm(x, norm: nn.GroupNorm, mask):
+    """
+    GroupNorm with statistics over the unmasked steps only
+
+    x: (B, C, T)
+    mask: (1, 1, T) with 1 for valid steps
+    """
+    B, C, T = x.shape
+    G = norm.num_groups
+    x = x.view(B, G, C // G, T)
+    mask = mask.view(1, 1, 1, T)
+    count = mask.sum() * (C // G)
+    mean = (x * mask).sum(dim=(2, 3), keepdim=True) / count
+    var = (((x - mean) * mask) ** 2).sum(dim=(2, 3), keepdim=True) / count
+    x = ((x - mean) / torch.sqrt(var + norm.eps)).view(B, C, T)
+    return x * norm.weight.view(1, -1, 1) + norm.bias.view(1, -1, 1)
 
 
 class ConditionalResidualBlock1D(nn.Module):
@@ -60,27 +82,32 @@ class ConditionalResidualBlock1D(nn.Module):
         kernel_size=3,
         n_groups=8,
         cond_predict_scale=False,
+        mid_channels=None,
     ):
         super().__init__()
+        # width between the two convs, smaller than out_channels once pruned
+        if mid_channels is None:
+            mid_channels = out_channels
 
         self.blocks = nn.ModuleList(
             [
-                Conv1dBlock(in_channels, out_channels, kernel_size, n_groups=n_groups),
-                Conv1dBlock(out_channels, out_channels, kernel_size, n_groups=n_groups),
+                Conv1dBlock(in_channels, mid_channels, kernel_size, n_groups=n_groups),
+                Conv1dBlock(mid_channels, out_channels, kernel_size, n_groups=n_groups),
             ]
         )
 
         # FiLM modulation https://arxiv.org/abs/1709.07871
         # predicts per-channel scale and bias
-        cond_channels = out_channels
+        cond_channels = mid_channels
         if cond_predict_scale:
-            cond_channels = out_channels * 2
+            cond_channels = mid_channels * 2
         self.cond_predict_scale = cond_predict_scale
         self.out_channels = out_channels
+        self.mid_channels = mid_channels
         self.cond_encoder = nn.Sequential(
             nn.Mish(),
             nn.Linear(cond_dim, cond_channels),
-            Rearrange("batch t -> batch t 1"),
+            nn.Unflatten(-1, (cond_channels, 1)),
         )
 
         # make sure dimensions compatible
@@ -89,29 +116,63 @@ class ConditionalResidualBlock1D(nn.Module):
             if in_channels != out_channels
             else nn.Identity()
         )
+        # recompute activations in the backward pass instead of storing them
+        self.checkpoint = False
 
-    def forward(self, x, cond):
+    def forward(self, x, cond, mask=None):
         """
         x : [ batch_size x in_channels x horizon ]
         cond : [ batch_size x cond_dim]
+        mask : [ 1 x 1 x horizon ] valid steps, or None without padding
 
         returns:
         out : [ batch_size x out_channels x horizon ]
         """
-        out = self.blocks[0](x)
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, cond, mask, use_reentrant=False)
+        return self._forward(x, cond, mask)
+
+    def _forward(self, x, cond, mask=None):
+        if mask is not None:
+            x = x * mask
+        out = self.blocks[0](x, mask)
         embed = self.cond_encoder(cond)
         if self.cond_predict_scale:
-            embed = embed.reshape(embed.shape[0], 2, self.out_channels, 1)
+            embed = embed.reshape(embed.shape[0], 2, self.mid_channels, 1)
             scale = embed[:, 0, ...]
             bias = embed[:, 1, ...]
             out = scale * out + bias
         else:
             out = out + embed
-        out = self.blocks[1](out)
+        out = self.blocks[1](out, mask)
         out = out + self.residual_conv(x)
+        if mask is not None:
+            out = out * mask
         return out
 
 
+class InputAffine(nn.Module):
+    """
+    Obs normalization x * scale + shift inside the model, the identity until
+    fold sets it for raw-unit inference. The first conditioning op of the UNets
+    is a Mish, so the affine cannot be folded into a linear layer and is kept as
+    one fused op.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.register_buffer("scale", None)
+        self.register_buffer("shift", None)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.scale is None:
+            return x
+        return torch.addcmul(self.shift, x, self.scale)
+
+    def fold(self, scale: torch.Tensor, shift: torch.Tensor):
+        self.scale, self.shift = scale.clone(), shift.clone()
+
+
 class ConditionalUnet1D(nn.Module):
     def __init__(
         self,
@@ -124,13 +185,16 @@ class ConditionalUnet1D(nn.Module):
         cond_mask_prob,
         weight_decay: float,
         inpaint: bool,
-        local_cond_dim=None,
         kernel_size=5,
         n_groups=8,
         cond_predict_scale=False,
+        input_dim=None,
+        checkpoint_frac=0.0,
+        block_channels=None,
     ):
         super().__init__()
-        input_dim = obs_dim + act_dim
+        if input_dim is None:
+            input_dim = obs_dim + act_dim
         all_dims = [input_dim] + list(down_dims)
         start_dim = down_dims[0]
         in_out = list(zip(all_dims[:-1], all_dims[1:]))
@@ -140,20 +204,18 @@ class ConditionalUnet1D(nn.Module):
             cond_embed_dim + 1 if inpaint else cond_embed_dim + obs_dim * (T_cond + 1) + 1
         )
 
-        CondResBlock = partial(
-            ConditionalResidualBlock1D,
-            cond_dim=cond_dim,
-            kernel_size=kernel_size,
-            n_groups=n_groups,
-            cond_predict_scale=cond_predict_scale,
-        )
-
-        local_cond_encoder = None
-        if local_cond_dim is not None:
-            _, dim_out = in_out[0]
-            dim_in = local_cond_dim
-            local_cond_encoder = nn.ModuleList(
-                [CondResBlock(dim_in, dim_out), CondResBlock(dim_in, dim_out)]
+        # hidden widths of the residual blocks in construction order, set by pruning
+        widths = iter(block_channels) if block_channels is not None else None
+
+        def CondResBlock(dim_in, dim_out):
+            return ConditionalResidualBlock1D(
+                dim_in,
+                dim_out,
+                cond_dim=cond_dim,
+                kernel_size=kernel_size,
+                n_groups=n_groups,
+                cond_predict_scale=cond_predict_scale,
+                mid_channels=next(widths) if widths is not None else None,
             )
 
         mid_dim = all_dims[-1]
@@ -197,11 +259,12 @@ class ConditionalUnet1D(nn.Module):
         self.cond_mask_prob = cond_mask_prob
         self.weight_decay = weight_decay
         self.inpaint = inpaint
+        self.obs_affine = InputAffine()
 
-        self.local_cond_encoder = local_cond_encoder
         self.up_modules = up_modules
         self.down_modules = down_modules
         self.final_conv = final_conv
+        self.set_checkpointing(checkpoint_frac)
 
         self.to(device)
 
@@ -215,65 +278,101 @@ class ConditionalUnet1D(nn.Module):
         sigma: torch.Tensor,
         data_dict: dict,
     ):
+        cond = self.get_cond(data_dict, noised_action.shape[0])
+        return self.forward_core(noised_action, sigma, cond)
+
+    def residual_blocks(self) -> list:
+        """
+        Residual blocks in construction order, the order of block_channels
+        """
+        blocks = list(self.mid_modules)
+        for mods in [*self.down_modules, *self.up_modules]:
+            blocks += list(mods[:2])
+        return blocks
+
+    def set_checkpointing(self, frac: float):
+        """
+        Checkpoint a fraction of the residual blocks, highest resolution first
+        since they hold the largest activations
+        """
+        # (resolution level, block), the up path runs from the deepest level
+        num_levels = len(self.down_modules)
+        blocks = [(i, m) for i, mods in enumerate(self.down_modules) for m in mods[:2]]
+        blocks += [(num_levels - 1, m) for m in self.mid_modules]
+        for i, mods in enumerate(self.up_modules):
+            blocks += [(num_levels - 1 - i, m) for m in mods[:2]]
+        blocks.sort(key=lambda b: b[0])
+
+        num_checkpointed = round(frac * len(blocks))
+        for i, (_, block) in enumerate(blocks):
+            block.checkpoint = i < num_checkpointed
+
+    def get_cond(self, data_dict: dict, batch_size: int) -> torch.Tensor:
+        """
+        Flatten the conditioning dict into a (B, cond_dim - cond_embed_dim) tensor
+        """
+        if self.inpaint:
+            return data_dict["returns"]
+        obs = self.obs_affine(data_dict["obs"]).reshape(batch_size, -1)
+        goal = self.obs_affine(data_dict["goal"])
+        return torch.cat([obs, goal, data_dict["returns"]], dim=-1)
+
+    def forward_core(self, x: torch.Tensor, sigma: torch.Tensor, cond: torch.Tensor):
         """
         x: (B,T,input_dim)
-        timestep: (B,) or int, diffusion step
-        local_cond: (B,T,local_cond_dim)
-        global_cond: (B,global_cond_dim)
+        sigma: (B,) preconditioned noise level
+        cond: (B,cond_dim - cond_embed_dim) from get_cond
         output: (B,T,input_dim)
         """
-        sample = einops.rearrange(noised_action, "b t h -> b h t")
-
         # embed timestep
-        sigma = sigma.to(noised_action.device)
+        sigma = sigma.to(x.device)
         sigma_emb = self.sigma_encoder(sigma.view(-1, 1))
-
-        # create global feature
-        if self.inpaint:
-            returns = data_dict["returns"]
-            global_feature = torch.cat([sigma_emb, returns], dim=-1)
-        else:
-            obs = data_dict["obs"].reshape(sample.shape[0], -1)
-            goal = data_dict["goal"]
-            returns = data_dict["returns"]
-            global_feature = torch.cat([sigma_emb, obs, goal, returns], dim=-1)
-
-        # encode local features
-        h_local = list()
-        local_cond = None
-        if self.local_cond_encoder is not None:
-            local_cond = einops.rearrange(local_cond, "b t h -> b h t")
-            resnet, resnet2 = self.local_cond_encoder
-            x = resnet(local_cond, global_feature)
-            h_local.append(x)
-            x = resnet2(local_cond, global_feature)
-            h_local.append(x)
-
-        x = sample
-        h = []
-        for idx, (resnet, resnet2, downsample) in enumerate(self.down_modules):
-            x = resnet(x, global_feature)
-            if idx == 0 and len(h_local) > 0:
-                x = x + h_local[0]
-            x = resnet2(x, global_feature)
-            h.append(x)
+        global_feature = torch.cat([sigma_emb, cond], dim=-1)
+
+        x = x.transpose(1, 2)
+        # pad to a length that survives the down/upsampling round trip
+        T = x.shape[-1]
+        factor = 2 ** (len(self.down_modules) - 1)
+        T_pad = -(-T // factor) * factor
+        masks = [None] * len(self.down_modules)
+        if T_pad != T:
+            x = F.pad(x, (0, T_pad - T))
+            masks = self.padding_masks(T, T_pad, x.device, x.dtype)
+
+        skips = []
+        for (resnet, resnet2, downsample), mask in zip(self.down_modules, masks):
+            x = resnet(x, global_feature, mask)
+            x = resnet2(x, global_feature, mask)
+            skips.append(x)
             x = downsample(x)
 
         for mid_module in self.mid_modules:
-            x = mid_module(x, global_feature)
-
-        for idx, (resnet, resnet2, upsample) in enumerate(self.up_modules):
-            x = torch.cat((x, h.pop()), dim=1)
-            x = resnet(x, global_feature)
-            if idx == (len(self.up_modules)) and len(h_local) > 0:
-                x = x + h_local[1]
-            x = resnet2(x, global_feature)
+            x = mid_module(x, global_feature, masks[-1])
+
+        # the deepest skips are consumed first, the highest resolution one is unused
+        for (resnet, resnet2, upsample), skip, mask in zip(
+            self.up_modules, reversed(skips), reversed(masks)
+        ):
+            x = torch.cat((x, skip), dim=1)
+            x = resnet(x, global_feature, mask)
+            x = resnet2(x, global_feature, mask)
             x = upsample(x)
 
-        x = self.final_conv(x)
+        x = self.final_conv[0](x, masks[0])
+        x = self.final_conv[1](x)
+        return x[..., :T].transpose(1, 2)
 
-        x = einops.rearrange(x, "b h t -> b t h")
-        return x
+    def padding_masks(self, T: int, T_pad: int, device, dtype) -> list[torch.Tensor]:
+        """
+        Valid steps of a length T input padded to T_pad, at every resolution
+        """
+        masks = []
+        for level in range(len(self.down_modules)):
+            steps = torch.arange(T_pad // 2**level, device=device)
+            masks.append((steps < T).to(dtype).view(1, 1, -1))
+            # a stride 2 conv output is valid if its center input is
+            T = (T + 1) // 2
+        return masks
 
     def mask_cond(self, cond, force_mask=False):
         cond = cond.clone()
@@ -288,6 +387,9 @@ class ConditionalUnet1D(nn.Module):
         else:
             return cond
 
+    def fold_input_affine(self, scale: torch.Tensor, shift: torch.Tensor):
+        self.obs_affine.fold(scale, shift)
+
     def get_optim_groups(self):
         return [{"params": self.parameters(), "weight_decay": self.weight_decay}]
 
@@ -307,13 +409,14 @@ class ValueUnet1D(nn.Module):
         cond_mask_prob,
         weight_decay: float,
         inpaint: bool,
-        local_cond_dim=None,
         kernel_size=5,
         n_groups=8,
         cond_predict_scale=False,
+        input_dim=None,
     ):
         super().__init__()
-        input_dim = obs_dim + act_dim
+        if input_dim is None:
+            input_dim = obs_dim + act_dim
         all_dims = [input_dim] + list(down_dims)
         start_dim = down_dims[0]
         in_out = list(zip(all_dims[:-1], all_dims[1:]))
@@ -344,10 +447,11 @@ class ValueUnet1D(nn.Module):
                 )
             )
 
-        fc_dim = all_dims[-1] * 64
+        # features are pooled over time so the head is independent of T
+        fc_dim = all_dims[-1]
 
         self.final_block = nn.Sequential(
-            nn.Linear(fc_dim + cond_embed_dim, fc_dim // 2),
+            nn.Linear(fc_dim + cond_dim, fc_dim // 2),
             nn.Mish(),
             nn.Linear(fc_dim // 2, 1),
         )
@@ -357,6 +461,7 @@ class ValueUnet1D(nn.Module):
         self.cond_mask_prob = cond_mask_prob
         self.weight_decay = weight_decay
         self.inpaint = inpaint
+        self.obs_affine = InputAffine()
 
         self.down_modules = down_modules
 
@@ -372,36 +477,38 @@ class ValueUnet1D(nn.Module):
         sigma: torch.Tensor,
         data_dict: dict,
     ):
+        cond = self.get_cond(data_dict, noised_action.shape[0])
+        return self.forward_core(noised_action, sigma, cond)
+
+    def get_cond(self, data_dict: dict, batch_size: int) -> torch.Tensor:
         """
-        x: (B,T,input_dim)
-        timestep: (B,) or int, diffusion step
-        local_cond: (B,T,local_cond_dim)
-        global_cond: (B,global_cond_dim)
-        output: (B,T,input_dim)
+        Flatten the conditioning dict into a (B, cond_dim - cond_embed_dim) tensor
         """
-        sample = einops.rearrange(noised_action, "b t h -> b h t")
+        if self.inpaint:
+            return data_dict["obs"].new_zeros((batch_size, 0))
+        obs = self.obs_affine(data_dict["obs"]).reshape(batch_size, -1)
+        goal = self.obs_affine(data_dict["goal"]).reshape(batch_size, -1)
+        return torch.cat([obs, goal], dim=-1)
 
+    def forward_core(self, x: torch.Tensor, sigma: torch.Tensor, cond: torch.Tensor):
+        """
+        x: (B,T,input_dim)
+        sigma: (B,) preconditioned noise level
+        cond: (B,cond_dim - cond_embed_dim) from get_cond
+        output: (B,1)
+        """
         # embed timestep
-        sigma = sigma.to(noised_action.device)
+        sigma = sigma.to(x.device)
         sigma_emb = self.sigma_encoder(sigma.view(-1, 1))
+        global_feature = torch.cat([sigma_emb, cond], dim=-1)
 
-        # create global feature
-        if self.inpaint:
-            global_feature = sigma_emb
-        else:
-            obs = data_dict["obs"].reshape(sample.shape[0], -1)
-            goal = data_dict["goal"].squeeze(1)
-            global_feature = torch.cat([sigma_emb, obs, goal], dim=-1)
-
-        x = sample
-        h = []
+        x = x.transpose(1, 2)
         for resnet, resnet2, downsample in self.down_modules:
             x = resnet(x, global_feature)
             x = resnet2(x, global_feature)
-            h.append(x)
             x = downsample(x)
 
-        x = x.view(x.shape[0], -1)
+        x = x.mean(dim=-1)
         x = self.final_block(torch.cat([x, global_feature], dim=-1))
         return x
 
@@ -418,6 +525,9 @@ class ValueUnet1D(nn.Module):
         else:
             return cond
 
+    def fold_input_affine(self, scale: torch.Tensor, shift: torch.Tensor):
+        self.obs_affine.fold(scale, shift)
+
     def get_optim_groups(self):
         return [{"params": self.parameters(), "weight_decay": self.weight_decay}]
 
@@ -1,8 +1,10 @@
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+import threading
 import torch
 import torch.nn as nn
+import types
 from torch.optim.adamw import AdamW
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
@@ -11,6 +13,7 @@ from diffusers.schedulers.scheduling_edm_dpmsolver_multistep import (
 )
 
 import wandb
+from locodiff.lora import inject_lora, lora_parameters
 from locodiff.utils import CFGWrapper, apply_conditioning, rand_log_logistic
 
 
@@ -37,17 +40,26 @@ class DiffusionPolicy(nn.Module):
         num_iters: int,
         inpaint: bool,
         device: str,
+        autoencoder=None,
+        value_model=None,
+        guide_scale: float = 0.0,
+        guide_every: int = 1,
+        guide_sigma_min: float = 0.0,
+        guide_sigma_max: float = float("inf"),
     ):
         super().__init__()
         # model
         if cond_mask_prob > 0:
             model = CFGWrapper(model, cond_lambda, cond_mask_prob)
         self.model = model
+        # latent diffusion
+        if autoencoder is not None and inpaint:
+            raise ValueError("Latent diffusion does not support inpainting")
+        self.autoencoder = autoencoder
 
         # other classes
         self.env = env
         self.normalizer = normalizer
-        self.obs_hist = torch.zeros((num_envs, T_cond, obs_dim), device=device)
         self.noise_scheduler = EDMDPMSolverMultistepScheduler(
             sigma_min=sigma_min,
             sigma_max=sigma_max,
@@ -65,6 +77,13 @@ class DiffusionPolicy(nn.Module):
         self.T_action = T_action
         self.num_envs = num_envs
         self.goal_dim = 4
+        # diffusion runs over the latent window when using an autoencoder
+        if autoencoder is not None:
+            self.sample_len = autoencoder.latent_len
+            self.sample_dim = autoencoder.latent_dim
+        else:
+            self.sample_len = self.input_len
+            self.sample_dim = self.input_dim
 
         # diffusion
         self.sampling_steps = sampling_steps
@@ -81,54 +100,117 @@ class DiffusionPolicy(nn.Module):
 
         # reward guidance
         self.gammas = torch.tensor([0.99**i for i in range(self.T)]).to(device)
+        self.value_model = value_model
+        if value_model is not None:
+            value_groups = value_model.get_optim_groups()
+            self.value_optimizer = AdamW(value_groups, lr=lr, betas=betas)
+        # the value gradient is only evaluated every guide_every steps inside the
+        # sigma window and reused in between
+        self.guide_scale = guide_scale
+        self.guide_every = guide_every
+        self.guide_sigma_min = guide_sigma_min
+        self.guide_sigma_max = guide_sigma_max
+
+        # raw-unit inference, set by fuse_normalizer
+        self.output_affine = None
 
         self.device = device
         self.to(device)
 
+        # default inference state, shares the training noise scheduler
+        self.session = PolicySession(self, num_envs, self.noise_scheduler)
+
     ############
     # Main API #
     ############
 
-    def act(self, data: dict) -> dict[str, torch.Tensor]:
-        data = self.process(data)
-        x = self.forward(data)
-        obs = x[:, :, self.action_dim :]
+    def act(self, data: dict, session=None) -> dict[str, torch.Tensor]:
+        session = self.session if session is None else session
+        data = self.process(data, session)
+        x = self.forward(data, session.noise_scheduler)
+        return self.split_plan(x)
 
-        # extract action
-        if self.inpaint:
-            action = x[
-                :, self.T_cond - 1 : self.T_cond + self.T_action - 1, : self.action_dim
-            ]
-        else:
-            action = x[:, : self.T_action, : self.action_dim]
+    @torch.no_grad()
+    def plan(self, obs, goals, session=None) -> dict[str, torch.Tensor]:
+        """
+        Plan from each env's observation towards K candidate goals in one batch
 
-        return {"action": action, "obs_traj": obs}
+        obs: (B, obs_dim), stacked on the session history for this call only,
+             the session is not updated, or (B, T_cond, obs_dim)
+        goals: (B, K, goal_dim)
+        returns: action (B, K, T_action, act_dim), obs_traj (B, K, T, obs_dim)
+                 and predicted returns (B, K)
+        """
+        session = self.session if session is None else session
+        obs, goals = obs.to(self.device), goals.to(self.device)
+        B, K = goals.shape[:2]
+        if obs.dim() == 2:
+            obs = torch.cat([session.obs_hist[:, 1:], obs.unsqueeze(1)], dim=1)
+
+        # normalize the conditioning once per env, then expand over goals
+        obs = self.scale_obs(obs[:, : self.T_cond])
+        goals = nn.functional.pad(goals, (0, self.obs_dim - goals.shape[-1]))
+        goals = self.scale_obs(goals).reshape(B * K, -1)
+        data = {
+            "obs": obs.repeat_interleave(K, dim=0),
+            "input": None,
+            "goal": goals,
+            "returns": torch.ones((B * K, 1), device=self.device),
+        }
+
+        x = self.forward(data, session.noise_scheduler)
+        returns = self.predict_return(x, data)
+        out = self.split_plan(x)
+        out = {k: v.reshape(B, K, *v.shape[1:]) for k, v in out.items()}
+        out["returns"] = returns.reshape(B, K)
+        return out
 
     def update(self, data):
         # preprocess data
         data = self.process(data)
         cond = self.create_conditioning(data)
+        target = self.training_target(data)
+        x_noise, sigma, inputs = self.noise_batch(target, data, cond)
 
-        # noise data
-        noise = torch.randn_like(data["input"])
-        sigma = self.sample_training_density(len(noise)).view(-1, 1, 1)
-        x_noise = data["input"] + noise * sigma
-        # scale inputs
-        x_noise_in = self.noise_scheduler.precondition_inputs(x_noise, sigma)
-        x_noise_in = apply_conditioning(x_noise_in, cond, self.action_dim)
-        sigma_in = self.noise_scheduler.precondition_noise(sigma)
+        # compute model output
+        out = self.denoised(self.model(*inputs), x_noise, sigma, cond)
+        # calculate loss
+        loss = torch.nn.functional.mse_loss(out, target)
 
-        # cfg masking
-        if self.cond_mask_prob > 0:
-            cond_mask = torch.rand_like(data["returns"]) < self.cond_mask_prob
-            data["returns"][cond_mask] = 0
+        # update model
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        self.lr_scheduler.step()
+
+        return loss.item()
+
+    def update_distill(self, data, teacher: "DiffusionPolicy"):
+        """
+        Regress the denoiser outputs of a trained teacher policy
+        """
+        data = self.process(data)
+        cond = self.create_conditioning(data)
+        target = self.training_target(data)
+
+        # sigmas are log-uniform to cover every sampling step, the cfg masking is
+        # shared so the student also learns the unconditional model
+        log_sigma = torch.empty(len(target), device=self.device).uniform_(
+            math.log(self.sigma_min), math.log(self.sigma_max)
+        )
+        x_noise, sigma, inputs = self.noise_batch(target, data, cond, log_sigma.exp())
+
+        # teacher denoiser without guidance
+        teacher_model = teacher.model
+        if isinstance(teacher_model, CFGWrapper):
+            teacher_model = teacher_model.model
+        with torch.no_grad():
+            target = self.denoised(teacher_model(*inputs), x_noise, sigma, cond)
 
         # compute model output
-        out = self.model(x_noise_in, sigma_in, data)
-        out = self.noise_scheduler.precondition_outputs(x_noise, out, sigma)
-        out = apply_conditioning(out, cond, self.action_dim)
+        out = self.denoised(self.model(*inputs), x_noise, sigma, cond)
         # calculate loss
-        loss = torch.nn.functional.mse_loss(out, data["input"])
+        loss = torch.nn.functional.mse_loss(out, target)
 
         # update model
         self.optimizer.zero_grad()
@@ -138,6 +220,27 @@ class DiffusionPolicy(nn.Module):
 
         return loss.item()
 
+    def update_value(self, data):
+        """
+        Regress returns from noised trajectories for value guidance
+        """
+        data = self.process(data)
+        cond = self.create_conditioning(data)
+        target = self.training_target(data)
+        # the returns are the regression target, so they are never masked
+        _, _, inputs = self.noise_batch(target, data, cond, cond_mask_prob=0.0)
+
+        # calculate loss
+        value = self.value_model(*inputs)
+        loss = torch.nn.functional.mse_loss(value, data["returns"])
+
+        # update model
+        self.value_optimizer.zero_grad()
+        loss.backward()
+        self.value_optimizer.step()
+
+        return loss.item()
+
     def test(self, data: dict, plot) -> tuple[float, float, float]:
         data = self.process(data)
         x = self.forward(data)
@@ -170,38 +273,66 @@ class DiffusionPolicy(nn.Module):
         return loss.mean().item(), obs_loss.item(), action_loss.item()
 
     def reset(self, dones=None):
-        if dones is not None:
-            self.obs_hist[dones.bool()] = 0
-        else:
-            self.obs_hist.zero_()
+        self.session.reset(dones)
+
+    def create_session(self, num_envs: int):
+        """
+        Create independent inference state for a client or env group. Sessions
+        share this policy's weights, so each can be driven from its own thread.
+        """
+        noise_scheduler = EDMDPMSolverMultistepScheduler.from_config(
+            self.noise_scheduler.config
+        )
+        return PolicySession(self, num_envs, noise_scheduler)
 
     #####################
     # Inference backend #
     #####################
 
     @torch.no_grad()
-    def forward(self, data: dict) -> torch.Tensor:
+    def forward(self, data: dict, noise_scheduler=None) -> torch.Tensor:
+        if noise_scheduler is None:
+            noise_scheduler = self.noise_scheduler
         # sample noise
         B = data["obs"].shape[0]
-        x = torch.randn((B, self.input_len, self.input_dim)).to(self.device)
+        x = torch.randn((B, self.sample_len, self.sample_dim)).to(self.device)
         # we should need this but performance is better without it
-        # x *= self.noise_scheduler.init_noise_sigma
+        # x *= noise_scheduler.init_noise_sigma
 
-        # create inpainting conditioning
+        # create inpainting conditioning, latents are only constrained once decoded
         cond = self.create_conditioning(data)
+        latent_cond = None if self.autoencoder is not None else cond
+        # obs/goal conditioning is constant over the loop
+        if hasattr(self.model, "cache_cond"):
+            cache = self.model.cache_cond(data)
+            if cache is not None:
+                data = {**data, "cond_cache": cache}
         # this needs to called every time we do inference
-        self.noise_scheduler.set_timesteps(self.sampling_steps)
+        noise_scheduler.set_timesteps(self.sampling_steps)
+        guide_steps = self.get_guide_steps(noise_scheduler)
+        grad = None
 
         # inference loop
-        for t in self.noise_scheduler.timesteps:
-            x_in = self.noise_scheduler.scale_model_input(x, t)
-            x_in = apply_conditioning(x_in, cond, 2)
+        for i, t in enumerate(noise_scheduler.timesteps):
+            x_in = noise_scheduler.scale_model_input(x, t)
+            x_in = apply_conditioning(x_in, latent_cond)
             output = self.model(x_in, t.expand(B), data)
-            x = self.noise_scheduler.step(output, t, x, return_dict=False)[0]
-
+            # value guidance
+            if guide_steps[i]:
+                if grad is None or i % self.guide_every == 0:
+                    grad = self.value_grad(x_in, t.expand(B), data)
+                output = output + self.guide_scale * grad
+            x = noise_scheduler.step(output, t, x, return_dict=False)[0]
+
+        # decode latents once at the end of sampling
+        if self.autoencoder is not None:
+            x = self.autoencoder.decode(x)
         # final conditioning
-        x = apply_conditioning(x, cond, 2)
+        x = apply_conditioning(x, cond)
         # denormalize
+        if self.output_affine is not None:
+            scale, shift, low, high = self.output_affine
+            return torch.addcmul(shift, x, scale).clamp_(low, high)
         x = self.normalizer.clip(x)
         x = self.normalizer.inverse_scale_output(x)
         return x
@@ -211,19 +342,23 @@ class DiffusionPolicy(nn.Module):
     ###################
 
     @torch.no_grad()
-    def process(self, data: dict) -> dict:
+    def process(self, data: dict, session=None) -> dict:
         data = self.dict_to_device(data)
         raw_action = data.get("action", None)
 
         if raw_action is None:
             # sim
-            data = self.update_history(data)
+            session = self.session if session is None else session
+            data = session.update_history(data)
             raw_obs = data["obs"]
             input = None
-            goal = self.normalizer.scale_input(self.goal)
+            goal = self.scale_obs(session.goal)
             returns = torch.ones_like(raw_obs[:, 0, :1])
+            waypoints = session.waypoints
         else:
             # train and test
+            if self.output_affine is not None:
+                raise ValueError("A fused normalizer is only used for inference")
             raw_obs = data["obs"]
             if self.inpaint:
                 input_obs, input_act = raw_obs, raw_action
@@ -240,15 +375,52 @@ class DiffusionPolicy(nn.Module):
 
             input = self.normalizer.scale_output(input)
             goal = input[range(input.shape[0]), lengths - 1, self.action_dim :]
+            waypoints = None
 
-        obs = self.normalizer.scale_input(raw_obs[:, : self.T_cond])
-        return {"obs": obs, "input": input, "goal": goal, "returns": returns}
+        obs = self.scale_obs(raw_obs[:, : self.T_cond])
+        out = {"obs": obs, "input": input, "goal": goal, "returns": returns}
+        if waypoints is not None:
+            out["waypoint_mask"] = waypoints[0]
+            out["waypoint_value"] = self.normalizer.scale_output(waypoints[1])
+        return out
 
-    def create_conditioning(self, data: dict) -> dict:
+    def split_plan(self, x: torch.Tensor) -> dict[str, torch.Tensor]:
+        obs = x[:, :, self.action_dim :]
+
+        # extract action
         if self.inpaint:
-            return {0: data["obs"].squeeze(1), self.T - 1: data["goal"]}
+            action = x[
+                :, self.T_cond - 1 : self.T_cond + self.T_action - 1, : self.action_dim
+            ]
         else:
-            return {}
+            action = x[:, : self.T_action, : self.action_dim]
+
+        return {"action": action, "obs_traj": obs}
+
+    def create_conditioning(self, data: dict) -> dict | None:
+        """
+        Build inpainting constraints as a boolean mask and values over
+        (B, input_len, input_dim), applied with a single torch.where
+        """
+        waypoint_mask = data.get("waypoint_mask", None)
+        if not self.inpaint and waypoint_mask is None:
+            return None
+
+        B = data["obs"].shape[0]
+        shape = (B, self.input_len, self.input_dim)
+        mask = torch.zeros(shape, dtype=torch.bool, device=self.device)
+        value = torch.zeros(shape, device=self.device)
+        if self.inpaint:
+            # pin the observation history and the goal
+            mask[:, : self.T_cond, self.action_dim :] = True
+            value[:, : self.T_cond, self.action_dim :] = data["obs"]
+            mask[:, self.T - 1, self.action_dim :] = True
+            value[:, self.T - 1, self.action_dim :] = data["goal"]
+        if waypoint_mask is not None:
+            mask = mask | waypoint_mask
+            value = torch.where(waypoint_mask, data["waypoint_value"], value)
+
+        return {"mask": mask, "value": value}
 
     def calculate_return(self, input):
         pos = input[:, :, 2:4]
@@ -273,10 +445,80 @@ class DiffusionPolicy(nn.Module):
 
         # return torch.zeros_like(input[:, 0, 0:1])
 
+    def predict_return(self, x: torch.Tensor, data: dict) -> torch.Tensor:
+        """
+        Score denormalized plans with the value model, or the analytic return
+        """
+        if self.value_model is None:
+            return self.calculate_return(x)
+
+        x = self.normalizer.scale_output(x)
+        if self.autoencoder is not None:
+            x = self.autoencoder.encode(x)[1]
+        sigma = torch.full((len(x), 1, 1), self.sigma_min, device=self.device)
+        x_in = self.noise_scheduler.precondition_inputs(x, sigma)
+        sigma_in = self.noise_scheduler.precondition_noise(sigma)
+        return self.value_model(x_in, sigma_in, data)
+
     ###########
     # Helpers #
     ###########
 
+    def get_guide_steps(self, noise_scheduler) -> list[bool]:
+        if self.value_model is None or self.guide_scale == 0:
+            return [False] * len(noise_scheduler.timesteps)
+        sigmas = noise_scheduler.sigmas[: len(noise_scheduler.timesteps)].tolist()
+        return [self.guide_sigma_min <= s <= self.guide_sigma_max for s in sigmas]
+
+    def value_grad(self, x, sigma, data):
+        # clone so inference tensors can take part in autograd
+        with torch.inference_mode(False), torch.enable_grad():
+            x = x.clone().requires_grad_(True)
+            cond = {k: v.clone() for k, v in data.items() if torch.is_tensor(v)}
+            value = self.value_model(x, sigma.clone(), cond)
+            return torch.autograd.grad(value.sum(), x)[0]
+
+    @torch.no_grad()
+    def training_target(self, data: dict) -> torch.Tensor:
+        """
+        Clean samples the denoiser learns, latents when using an autoencoder
+        """
+        if self.autoencoder is not None:
+            return self.autoencoder.encode(data["input"])[1]
+        return data["input"]
+
+    def noise_batch(self, target, data, cond, sigma=None, cond_mask_prob=None):
+        """
+        Noise the targets at sigma, from the training density by default, and
+        build the preconditioned model inputs with cfg-masked returns. Shared by
+        every training path.
+
+        returns: x_noise, sigma (B, 1, 1) and the inputs (x_noise_in, sigma_in, data)
+        """
+        if sigma is None:
+            sigma = self.sample_training_density(len(target))
+        sigma = sigma.view(-1, 1, 1)
+        x_noise = target + torch.randn_like(target) * sigma
+        # scale inputs
+        x_noise_in = self.noise_scheduler.precondition_inputs(x_noise, sigma)
+        x_noise_in = apply_conditioning(x_noise_in, cond)
+        sigma_in = self.noise_scheduler.precondition_noise(sigma)
+
+        # cfg masking, a tensor cond_mask_prob works under vmap
+        if cond_mask_prob is None:
+            cond_mask_prob = self.cond_mask_prob
+        returns = data["returns"]
+        cond_mask = torch.rand_like(returns) < cond_mask_prob
+        data = {**data, "returns": torch.where(cond_mask, 0, returns)}
+        return x_noise, sigma, (x_noise_in, sigma_in, data)
+
+    def denoised(self, out, x_noise, sigma, cond) -> torch.Tensor:
+        """
+        Denoised prediction from the raw model output
+        """
+        out = self.noise_scheduler.precondition_outputs(x_noise, out, sigma)
+        return apply_conditioning(out, cond)
+
     @torch.no_grad()
     def sample_training_density(self, size):
         """
@@ -288,6 +530,107 @@ class DiffusionPolicy(nn.Module):
         )
         return density
 
+    def update_history(self, x):
+        return self.session.update_history(x)
+
+    def set_goal(self, goal):
+        self.session.set_goal(goal)
+
+    def dict_to_device(self, data):
+        return {k: v.to(self.device) for k, v in data.items()}
+
+    def get_params(self):
+        # frozen base weights are neither optimized nor averaged
+        return [p for p in self.model.get_params() if p.requires_grad]
+
+    def add_adapters(self, rank: int, alpha: float | None = None, targets=None):
+        """
+        Freeze the denoiser and train LoRA adapters instead, with a fresh
+        optimizer and lr schedule over the adapter weights
+        """
+        model = self.model.model if isinstance(self.model, CFGWrapper) else self.model
+        names = inject_lora(model, rank, alpha, targets)
+        self.optimizer = AdamW(
+            [{"params": lora_parameters(model), "weight_decay": 0.0}],
+            lr=self.optimizer.defaults["lr"],
+            betas=self.optimizer.defaults["betas"],
+        )
+        self.lr_scheduler = CosineAnnealingLR(
+            self.optimizer, T_max=self.lr_scheduler.T_max
+        )
+        return names
+
+    def scale_obs(self, obs: torch.Tensor) -> torch.Tensor:
+        # fused models normalize obs and goals themselves
+        if self.output_affine is not None:
+            return obs
+        return self.normalizer.scale_input(obs)
+
+    @torch.no_grad()
+    def fuse_normalizer(self):
+        """
+        Fold the obs normalization into the conditioning layers of the denoiser
+        and value model, and the output clip and denormalization into one affine
+        and clamp. Models then take raw units, so call this once, after the
+        final weights are loaded, and do not train or save the policy afterwards.
+        """
+        if self.inpaint:
+            raise ValueError("Inpainting pins normalized obs into the plan")
+        if self.output_affine is not None:
+            return
+        scale, shift = self.normalizer.input_affine()
+        for model in [self.model, self.value_model]:
+            if isinstance(model, CFGWrapper):
+                model = model.model
+            if model is not None:
+                model.fold_input_affine(scale, shift)
+        self.output_affine = self.normalizer.output_affine()
+
+    def compile_model(self, **compile_kwargs):
+        """
+        Compile forward_core of the denoiser and value model, which takes
+        tensors only and so has no graph breaks. Dict handling, CFG and the
+        sampling loop stay in eager mode.
+        """
+        models = [self.model, self.value_model]
+        for model in models:
+            if isinstance(model, CFGWrapper):
+                model = model.model
+            if model is None or not hasattr(model, "forward_core"):
+                continue
+            # compile the unbound function and bind it to the model, deepcopies
+            # (ensembles, sweep replicas) then rebind it to the copied module
+            forward_core = torch.compile(type(model).forward_core, **compile_kwargs)
+            model.forward_core = types.MethodType(forward_core, model)
+
+
+class PolicySession:
+    """
+    Per-client inference state: observation history, goal and solver state.
+    The policy weights are shared and only read during sampling.
+    """
+
+    def __init__(self, policy: DiffusionPolicy, num_envs: int, noise_scheduler):
+        self.policy = policy
+        self.noise_scheduler = noise_scheduler
+        self.obs_hist = torch.zeros(
+            (num_envs, policy.T_cond, policy.obs_dim), device=policy.device
+        )
+        self.goal = None
+        self.waypoints = None
+        # serialises calls that share this session's state
+        self.lock = threading.Lock()
+
+    def act(self, data: dict) -> dict[str, torch.Tensor]:
+        with self.lock:
+            return self.policy.act(data, session=self)
+
+    def reset(self, dones=None):
+        if dones is not None:
+            self.obs_hist[dones.bool()] = 0
+        else:
+            self.obs_hist.zero_()
+
     def update_history(self, x):
         self.obs_hist[:, :-1] = self.obs_hist[:, 1:].clone()
         self.obs_hist[:, -1] = x["obs"]
@@ -295,10 +638,18 @@ class DiffusionPolicy(nn.Module):
         return x
 
     def set_goal(self, goal):
+        goal = goal.to(self.policy.device)
         self.goal = torch.cat([goal, torch.zeros_like(goal)], dim=-1)
 
-    def dict_to_device(self, data):
-        return {k: v.to(self.device) for k, v in data.items()}
+    def set_waypoints(self, mask=None, value=None):
+        """
+        Pin arbitrary plan entries per env, in raw units. Pass None to clear.
 
-    def get_params(self):
-        return self.model.get_params()
+        mask: (num_envs, input_len, act_dim + obs_dim), True where value is pinned
+        value: (num_envs, input_len, act_dim + obs_dim)
+        """
+        if mask is None:
+            self.waypoints = None
+        else:
+            device = self.policy.device
+            self.waypoints = (mask.to(device).bool(), value.to(device))
@@ -0,0 +1,149 @@
+import csv
+import time
+import torch
+import torch.nn as nn
+from functools import partial
+
+from locodiff.benchmark import synchronize
+from locodiff.models.attention import CrossAttention, SelfAttention
+
+
+def module_flops(module: nn.Module, args: tuple, kwargs: dict, output) -> int:
+    """
+    Estimated FLOPs of a module's own computation, children excluded
+    """
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, nn.Conv1d):
+        kernel = module.kernel_size[0]
+        return 2 * output.numel() * module.in_channels // module.groups * kernel
+    if isinstance(module, nn.ConvTranspose1d):
+        kernel = module.kernel_size[0]
+        return 2 * args[0].numel() * module.out_channels // module.groups * kernel
+    if isinstance(module, (nn.GroupNorm, nn.LayerNorm)):
+        return 5 * output.numel()
+    if isinstance(module, SelfAttention):
+        # q @ k and attn @ v over the attended keys
+        B, T, C = args[0].shape
+        num_keys = T if module.window is None else 3 * module.window + module.num_global
+        return 4 * B * T * min(T, num_keys) * C
+    if isinstance(module, CrossAttention):
+        B, T, C = args[0].shape
+        memory = args[1] if len(args) > 1 else kwargs.get("memory", None)
+        kv = args[2] if len(args) > 2 else kwargs.get("kv", None)
+        S = kv.shape[-2] if kv is not None else memory.shape[1]
+        return 4 * B * T * S * C
+    return 0
+
+
+class ModuleProfiler:
+    """
+    Parameters, estimated FLOPs, wall time and peak memory of every submodule,
+    collected with forward hooks. FLOPs, time and memory of a module include
+    its children. Peak memory is only tracked on CUDA. Every module is hooked,
+    only those at most max_depth levels deep are reported.
+    """
+
+    def __init__(self, model: nn.Module, device="cpu", max_depth: int | None = 4):
+        self.model = model
+        self.device = device
+        self.max_depth = max_depth
+        self.cuda = torch.device(device).type == "cuda"
+        # the empty name is the whole model
+        self.modules = dict(model.named_modules())
+        self.stats = {
+            name: {"flops": 0, "ms": 0.0, "out_mb": 0.0, "peak_mb": 0.0}
+            for name in self.modules
+        }
+        self.num_calls = 0
+        self.stack = []
+        self.hooks = []
+
+    def pre_hook(self, name, module, args, kwargs):
+        synchronize(self.device)
+        memory = 0
+        if self.cuda:
+            memory = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.stack.append((name, time.perf_counter(), memory, 0.0))
+
+    def post_hook(self, name, module, args, kwargs, output):
+        synchronize(self.device)
+        _, start, memory, child_peak = self.stack.pop()
+        stats = self.stats[name]
+        stats["ms"] += (time.perf_counter() - start) * 1e3
+        stats["flops"] += module_flops(module, args, kwargs, output)
+        if torch.is_tensor(output):
+            stats["out_mb"] = output.numel() * output.element_size() / 2**20
+
+        if self.cuda:
+            # children reset the peak, so their peaks are carried up the stack
+            peak = torch.cuda.max_memory_allocated(self.device) - memory
+            peak = max(peak, child_peak)
+            stats["peak_mb"] = max(stats["peak_mb"], peak / 2**20)
+            if self.stack:
+                parent, parent_start, parent_memory, parent_peak = self.stack[-1]
+                peak = max(peak + memory - parent_memory, parent_peak)
+                self.stack[-1] = (parent, parent_start, parent_memory, peak)
+
+    def __enter__(self):
+        for name, module in self.modules.items():
+            pre_hook = partial(self.pre_hook, name)
+            post_hook = partial(self.post_hook, name)
+            self.hooks.append(
+                module.register_forward_pre_hook(pre_hook, with_kwargs=True)
+            )
+            self.hooks.append(module.register_forward_hook(post_hook, with_kwargs=True))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    @torch.no_grad()
+    def profile(self, *args, num_iters: int = 10, **kwargs) -> list[dict]:
+        """
+        Run the model num_iters times under the hooks and return one row per module
+        """
+        # warm up without hooks
+        self.model(*args, **kwargs)
+        with self:
+            for _ in range(num_iters):
+                self.model(*args, **kwargs)
+        self.num_calls = num_iters
+        return self.rows()
+
+    def rows(self) -> list[dict]:
+        # own FLOPs are summed into every ancestor
+        flops = {name: 0 for name in self.stats}
+        for name, stats in self.stats.items():
+            for other in flops:
+                if other == "" or name == other or name.startswith(other + "."):
+                    flops[other] += stats["flops"]
+
+        rows = []
+        for name, module in self.modules.items():
+            depth = name.count(".") + 1 if name else 0
+            if self.max_depth is not None and depth > self.max_depth:
+                continue
+            stats = self.stats[name]
+            rows.append(
+                {
+                    "module": name or "(total)",
+                    "type": type(module).__name__,
+                    "params": sum(p.numel() for p in module.parameters()),
+                    "mflops": flops[name] / self.num_calls / 1e6,
+                    "ms": stats["ms"] / self.num_calls,
+                    "out_mb": stats["out_mb"],
+                    "peak_mb": stats["peak_mb"] if self.cuda else float("nan"),
+                }
+            )
+        return rows
+
+
+def export_csv(rows: list[dict], path: str):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
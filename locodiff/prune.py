@@ -0,0 +1,103 @@
+import logging
+import torch
+from functools import partial
+from itertools import islice
+
+from locodiff.models.unet import ConditionalResidualBlock1D, ConditionalUnet1D
+from locodiff.utils import CFGWrapper, apply_conditioning
+
+log = logging.getLogger(__name__)
+
+
+def magnitude_scores(block: ConditionalResidualBlock1D) -> torch.Tensor:
+    """
+    Importance of each hidden channel: its filter norm times its GroupNorm gain,
+    since the gain sets the scale of the normalized channel
+    """
+    conv, norm = block.blocks[0].block[0], block.blocks[0].block[1]
+    filter_norm = conv.weight.detach().flatten(1).norm(dim=1)
+    return filter_norm * norm.weight.detach().abs()
+
+
+@torch.no_grad()
+def activation_scores(policy, data_loader, num_batches: int) -> list[torch.Tensor]:
+    """
+    Mean absolute hidden activation of each residual block on noised training
+    batches, in the order of ConditionalUnet1D.residual_blocks
+    """
+    model = policy.model.model if isinstance(policy.model, CFGWrapper) else policy.model
+    blocks = model.residual_blocks()
+    scores = [torch.zeros(b.mid_channels, device=policy.device) for b in blocks]
+
+    def accumulate(i, module, inputs, output):
+        scores[i] += output.abs().mean(dim=(0, 2))
+
+    hooks = [
+        b.blocks[0].register_forward_hook(partial(accumulate, i))
+        for i, b in enumerate(blocks)
+    ]
+    for batch in islice(data_loader, num_batches):
+        # noise the data like DiffusionPolicy.update
+        data = policy.process(batch)
+        x = data["input"]
+        if policy.autoencoder is not None:
+            x = policy.autoencoder.encode(x)[1]
+        sigma = policy.sample_training_density(len(x)).view(-1, 1, 1)
+        x_noise = x + torch.randn_like(x) * sigma
+        x_in = policy.noise_scheduler.precondition_inputs(x_noise, sigma)
+        x_in = apply_conditioning(x_in, policy.create_conditioning(data))
+        sigma_in = policy.noise_scheduler.precondition_noise(sigma)
+        model(x_in, sigma_in, data)
+
+    for hook in hooks:
+        hook.remove()
+    return scores
+
+
+def prune_unet(
+    model: ConditionalUnet1D, ratio: float, scores: list[torch.Tensor] | None = None
+) -> tuple[list[int], dict]:
+    """
+    Remove the lowest scoring hidden channels of every residual block.
+
+    The same number of channels is dropped from each GroupNorm group, so the
+    group count stays valid and every kept channel stays in its group.
+    Returns the new block_channels and the matching state dict.
+    """
+    blocks = model.residual_blocks()
+    if scores is None:
+        scores = [magnitude_scores(b) for b in blocks]
+    names = {module: name for name, module in model.named_modules()}
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+
+    widths = []
+    for block, score in zip(blocks, scores):
+        num_groups = block.blocks[0].block[1].num_groups
+        group_size = block.mid_channels // num_groups
+        keep = max(1, round(group_size * (1 - ratio)))
+        # top channels of each group, in their original order
+        top = score.view(num_groups, group_size).topk(keep, dim=1).indices
+        offsets = torch.arange(num_groups, device=top.device).view(-1, 1) * group_size
+        idx = (top.sort(dim=1).values + offsets).flatten()
+        widths.append(len(idx))
+
+        prefix = names[block]
+        # first conv and its GroupNorm
+        for key in ["blocks.0.block.0", "blocks.0.block.1"]:
+            for param in ["weight", "bias"]:
+                name = f"{prefix}.{key}.{param}"
+                state_dict[name] = state_dict[name][idx]
+        # FiLM rows, scales and biases are stacked when predicting the scale
+        film_idx = idx
+        if block.cond_predict_scale:
+            film_idx = torch.cat([idx, idx + block.mid_channels])
+        for param in ["weight", "bias"]:
+            name = f"{prefix}.cond_encoder.1.{param}"
+            state_dict[name] = state_dict[name][film_idx]
+        # input channels of the second conv
+        name = f"{prefix}.blocks.1.block.0.weight"
+        state_dict[name] = state_dict[name][:, idx]
+
+    num_before = sum(b.mid_channels for b in blocks)
+    log.info(f"Pruned hidden channels from {num_before} to {sum(widths)}")
+    return widths, state_dict
@@ -6,20 +6,24 @@ import torch
 from collections import deque
 from tqdm import tqdm, trange
 
+from hydra.utils import get_class
 from rsl_rl.env import VecEnv
 from rsl_rl.utils import store_code_state
 
 import wandb
 from locodiff.dataset import get_dataloaders
 from locodiff.envs import MazeEnv
-from locodiff.models.transformer import DiffusionTransformer
-from locodiff.models.unet import ConditionalUnet1D
+from locodiff.lora import load_lora_state_dict, lora_state_dict
+from locodiff.models.autoencoder import TrajectoryVAE
+from locodiff.models.unet import ValueUnet1D
 from locodiff.policy import DiffusionPolicy
 from locodiff.utils import ExponentialMovingAverage, InferenceContext, Normalizer
 
 # A logger for this file
 log = logging.getLogger(__name__)
 
+DEFAULT_MODEL = "locodiff.models.unet.ConditionalUnet1D"
+
 
 class DiffusionRunner:
     def __init__(
@@ -33,10 +37,32 @@ class DiffusionRunner:
         # classes
         self.train_loader, self.test_loader = get_dataloaders(**self.cfg.dataset)
         self.normalizer = Normalizer(self.train_loader, agent_cfg.scaling, device)
-        # TODO: init model with hydra
-        model = ConditionalUnet1D(**self.cfg.model)
-        # model = DiffusionTransformer(**self.cfg.model)
-        self.policy = DiffusionPolicy(model, self.normalizer, env, **self.cfg.policy)
+        # latent diffusion
+        self.autoencoder = None
+        if self.cfg.get("latent_diffusion", False):
+            self.autoencoder = TrajectoryVAE(
+                input_dim=self.cfg.obs_dim + self.cfg.act_dim,
+                T=self.cfg.T,
+                device=device,
+                **self.cfg.autoencoder,
+            )
+        # value guidance
+        value_model = None
+        if self.cfg.get("value_guidance", False):
+            value_model = self.create_value_model()
+        model = self.create_model()
+        self.policy = DiffusionPolicy(
+            model,
+            self.normalizer,
+            env,
+            autoencoder=self.autoencoder,
+            value_model=value_model,
+            **self.cfg.policy,
+        )
+
+        # the first calls of each input shape pay the compile time
+        if self.cfg.get("compile", False):
+            self.policy.compile_model()
 
         # ema
         self.ema_helper = ExponentialMovingAverage(
@@ -53,6 +79,8 @@ class DiffusionRunner:
             self.num_steps_per_env = int(self.cfg.episode_length / 0.1)
         self.log_dir = log_dir
         self.current_learning_iteration = 0
+        # adapter settings, set when fine-tuning with LoRA
+        self.lora_cfg = None
 
         # logging
         if self.log_dir is not None:
@@ -63,7 +91,33 @@ class DiffusionRunner:
             # save git diffs
             store_code_state(self.log_dir, [__file__])
 
+    def create_model(self) -> torch.nn.Module:
+        """
+        Build the denoiser from the model config, the UNet by default
+        """
+        model_cfg = dict(self.cfg.model)
+        # every model takes input_dim, which defaults to obs_dim + act_dim and is
+        # the latent width for latent diffusion
+        if self.autoencoder is not None:
+            model_cfg["input_dim"] = self.autoencoder.latent_dim
+            if "T" in model_cfg:
+                model_cfg["T"] = self.autoencoder.latent_len
+        model_cls = get_class(model_cfg.pop("_target_", DEFAULT_MODEL))
+        return model_cls(**model_cfg)
+
+    def create_value_model(self) -> ValueUnet1D:
+        """
+        Build the value model, over latents when using an autoencoder
+        """
+        value_cfg = dict(self.cfg.value_model)
+        if self.autoencoder is not None:
+            value_cfg["input_dim"] = self.autoencoder.latent_dim
+        return ValueUnet1D(**value_cfg)
+
     def learn(self):
+        if self.autoencoder is not None and not self.autoencoder.trained:
+            self.learn_autoencoder()
+
         obs, _ = self.env.get_observations()
         obs = obs.to(self.device)
         self.policy.reset()
@@ -159,7 +213,9 @@ class DiffusionRunner:
                 batch = next(generator)
 
             loss = self.policy.update(batch)
-            self.ema_helper.update(self.policy.parameters())
+            self.ema_helper.update(self.policy.get_params())
+            if self.policy.value_model is not None:
+                value_loss = self.policy.update_value(batch)
 
             # logging
             self.current_learning_iteration = it
@@ -175,6 +231,61 @@ class DiffusionRunner:
         if self.log_dir is not None:
             self.save(os.path.join(self.log_dir, "models", "model.pt"))
 
+    def learn_autoencoder(self):
+        """
+        Fit the trajectory autoencoder used for latent diffusion, then freeze it
+        """
+        self.autoencoder.train()
+        generator = iter(self.train_loader)
+        pbar = trange(int(self.autoencoder.num_iters), desc="Training autoencoder...")
+        for it in pbar:
+            try:
+                batch = next(generator)
+            except StopIteration:
+                generator = iter(self.train_loader)
+                batch = next(generator)
+
+            x = self.policy.process(batch)["input"]
+            loss, recon_loss, kl_loss = self.autoencoder.update(x)
+
+            if it % self.cfg.log_interval == 0:
+                pbar.set_postfix(recon_loss=recon_loss, kl_loss=kl_loss)
+
+        self.autoencoder.freeze()
+        log.info(f"Autoencoder trained | recon loss: {recon_loss:.4f}")
+
+    def distill(self, teacher: DiffusionPolicy, num_iters: int):
+        """
+        Train this runner's policy to match the denoiser of a trained teacher
+        """
+        # the student has to see the data in the teacher's normalized space
+        self.normalizer.load_state_dict(teacher.normalizer.state_dict())
+        teacher.eval()
+        self.train_mode()
+
+        start_iter = self.current_learning_iteration
+        tot_iter = int(start_iter + num_iters)
+        generator = iter(self.train_loader)
+        pbar = trange(start_iter, tot_iter, desc="Distilling...")
+        for it in pbar:
+            try:
+                batch = next(generator)
+            except StopIteration:
+                generator = iter(self.train_loader)
+                batch = next(generator)
+
+            loss = self.policy.update_distill(batch, teacher)
+            self.ema_helper.update(self.policy.get_params())
+
+            self.current_learning_iteration = it
+            if it % self.cfg.log_interval == 0:
+                pbar.set_postfix(distill_loss=loss)
+                if self.log_dir is not None:
+                    wandb.log({"Loss/distill_loss": loss}, step=it)
+
+        if self.log_dir is not None:
+            self.save(os.path.join(self.log_dir, "models", "model.pt"))
+
     def log(self, locs: dict):
         # training
         wandb.log(
@@ -184,6 +295,8 @@ class DiffusionRunner:
             },
             step=locs["it"],
         )
+        if "value_loss" in locs:
+            wandb.log({"Loss/value_loss": locs["value_loss"]}, step=locs["it"])
         # evaluation
         if locs["it"] % self.cfg.eval_interval == 0:
             wandb.log(
@@ -226,9 +339,13 @@ class DiffusionRunner:
             )
 
     def save(self, path, infos=None):
+        # the frozen base model is already saved, only keep the adapters
+        if self.lora_cfg is not None:
+            return self.save_adapters(path, infos)
+
         if self.use_ema:
-            self.ema_helper.store(self.policy.parameters())
-            self.ema_helper.copy_to(self.policy.parameters())
+            self.ema_helper.store(self.policy.get_params())
+            self.ema_helper.copy_to(self.policy.get_params())
 
         saved_dict = {
             "model_state_dict": self.policy.state_dict(),
@@ -240,20 +357,74 @@ class DiffusionRunner:
         torch.save(saved_dict, path)
 
         if self.use_ema:
-            self.ema_helper.restore(self.policy.parameters())
+            self.ema_helper.restore(self.policy.get_params())
 
     def load(self, path):
         loaded_dict = torch.load(path)
-        self.policy.load_state_dict(loaded_dict["model_state_dict"])
+        model_state_dict = loaded_dict["model_state_dict"]
+        # nn.TransformerDecoder checkpoints are converted when loading the model,
+        # but their optimizer groups hold a different number of parameters
+        legacy = any(".decoder.layers." in k for k in model_state_dict)
+        self.policy.load_state_dict(model_state_dict)
         self.normalizer.load_state_dict(loaded_dict["norm_state_dict"])
-        self.policy.optimizer.load_state_dict(loaded_dict["optimizer_state_dict"])
+        if legacy:
+            log.warning("Legacy transformer checkpoint, not loading optimizer state")
+        else:
+            self.policy.optimizer.load_state_dict(loaded_dict["optimizer_state_dict"])
+        if self.autoencoder is not None and self.autoencoder.trained:
+            self.autoencoder.freeze()
         self.current_learning_iteration = loaded_dict["iter"]
         return loaded_dict["infos"]
 
-    def get_inference_policy(self, device=None):
+    def add_adapters(self, rank: int, alpha: float | None = None, targets=None):
+        """
+        Freeze the loaded model and fine-tune LoRA adapters on this runner's data
+        """
+        self.lora_cfg = {"rank": rank, "alpha": alpha, "targets": targets}
+        self.policy.add_adapters(rank, alpha, targets)
+        self.ema_helper = ExponentialMovingAverage(
+            self.policy.get_params(), self.cfg.ema_decay, self.cfg.device
+        )
+
+    def save_adapters(self, path, infos=None):
+        """
+        Save only the adapter weights, to be swapped onto the same base model
+        """
+        if self.use_ema:
+            self.ema_helper.store(self.policy.get_params())
+            self.ema_helper.copy_to(self.policy.get_params())
+
+        saved_dict = {
+            "adapter_state_dict": lora_state_dict(self.policy),
+            "lora": self.lora_cfg,
+            "norm_state_dict": self.normalizer.state_dict(),
+            "iter": self.current_learning_iteration,
+            "infos": infos,
+        }
+        torch.save(saved_dict, path)
+
+        if self.use_ema:
+            self.ema_helper.restore(self.policy.get_params())
+
+    def load_adapters(self, path):
+        """
+        Swap in saved adapters, adding them first if the model has none
+        """
+        loaded_dict = torch.load(path)
+        if self.lora_cfg is None:
+            self.add_adapters(**loaded_dict["lora"])
+        load_lora_state_dict(self.policy, loaded_dict["adapter_state_dict"])
+        self.normalizer.load_state_dict(loaded_dict["norm_state_dict"])
+        self.ema_helper.load_shadow_params(self.policy.get_params())
+        return loaded_dict["infos"]
+
+    def get_inference_policy(self, device=None, fuse_normalizer=False):
         self.eval_mode()
         if device is not None:
             self.policy.to(device)
+        # deployment only, the fused policy takes raw units and cannot be trained
+        if fuse_normalizer:
+            self.policy.fuse_normalizer()
         return self.policy.act
 
     def train_mode(self):
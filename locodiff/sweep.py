@@ -0,0 +1,217 @@
+import logging
+import math
+import os
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from omegaconf import OmegaConf
+from tqdm import trange
+
+import wandb
+from locodiff.ensemble import PolicyEnsemble
+from locodiff.runner import DiffusionRunner
+from locodiff.utils import CFGWrapper, ExponentialMovingAverage
+
+log = logging.getLogger(__name__)
+
+
+class SweepRunner(DiffusionRunner):
+    """
+    Trains N replicas of the configured model side by side on one batch stream.
+    The replica weights are stacked and every training step is a single vmapped
+    call. Each replica has its own seed, learning rate and cond_mask_prob.
+    """
+
+    def __init__(self, env, agent_cfg, log_dir: str | None = None, device="cpu"):
+        super().__init__(env, agent_cfg, log_dir=log_dir, device=device)
+        if self.autoencoder is not None or self.policy.value_model is not None:
+            raise ValueError("Sweeps only train the diffusion model")
+
+        # scalar settings are shared by all replicas
+        sweep_cfg = OmegaConf.to_container(agent_cfg.sweep, resolve=True)
+        sweep = {
+            "seed": sweep_cfg.get("seed", agent_cfg.seed),
+            "lr": sweep_cfg.get("lr", agent_cfg.policy.lr),
+            "cond_mask_prob": sweep_cfg.get(
+                "cond_mask_prob", agent_cfg.policy.cond_mask_prob
+            ),
+        }
+        self.num_replicas = max(
+            [len(v) for v in sweep.values() if isinstance(v, list)], default=1
+        )
+        self.hparams = [
+            {k: v[i] if isinstance(v, list) else v for k, v in sweep.items()}
+            for i in range(self.num_replicas)
+        ]
+
+        # replicas are initialized from their own seeds
+        models = []
+        for hparams in self.hparams:
+            torch.manual_seed(hparams["seed"])
+            models.append(self.create_model().train())
+        params, self.buffers = stack_module_state(models)
+        self.params = {k: torch.nn.Parameter(v) for k, v in params.items()}
+
+        # the policy's model is the stateless template of the replicas
+        self.base = self.policy.model
+        if isinstance(self.base, CFGWrapper):
+            self.base = self.base.model
+
+        # adamw state, with the weight decay of the model's param groups
+        self.lr = torch.tensor([h["lr"] for h in self.hparams], device=device)
+        self.cond_mask_prob = torch.tensor(
+            [h["cond_mask_prob"] for h in self.hparams], device=device
+        )
+        self.betas = tuple(agent_cfg.policy.betas)
+        names = {id(p): n for n, p in models[0].named_parameters()}
+        self.weight_decay = {
+            names[id(p)]: group["weight_decay"]
+            for group in models[0].get_optim_groups()
+            for p in group["params"]
+        }
+        self.exp_avg = {k: torch.zeros_like(v) for k, v in self.params.items()}
+        self.exp_avg_sq = {k: torch.zeros_like(v) for k, v in self.params.items()}
+        self.num_updates = 0
+
+        self.ema_helper = ExponentialMovingAverage(
+            self.params.values(), self.cfg.ema_decay, self.cfg.device
+        )
+        log.info(f"Sweeping {self.num_replicas} replicas: {self.hparams}")
+
+    def learn(self):
+        self.train_mode()
+        start_iter = self.current_learning_iteration
+        tot_iter = int(start_iter + self.cfg.num_iters)
+        generator = iter(self.train_loader)
+        for it in trange(start_iter, tot_iter):
+            # evaluation
+            if it % self.cfg.eval_interval == 0:
+                metrics = self.evaluate()
+                if self.log_dir is not None:
+                    wandb.log(
+                        {
+                            f"Loss/test_mse_{i}": m["mse"]
+                            for i, m in enumerate(metrics)
+                        },
+                        step=it,
+                    )
+
+            # training
+            try:
+                batch = next(generator)
+            except StopIteration:
+                generator = iter(self.train_loader)
+                batch = next(generator)
+
+            losses = self.update(batch)
+            self.ema_helper.update(self.params.values())
+
+            # logging
+            self.current_learning_iteration = it
+            if self.log_dir is not None and it % self.cfg.log_interval == 0:
+                wandb.log(
+                    {f"Loss/loss_{i}": loss for i, loss in enumerate(losses)},
+                    step=it,
+                )
+
+        if self.log_dir is not None:
+            self.save(os.path.join(self.log_dir, "models"))
+
+    def update(self, data) -> list[float]:
+        """
+        One training step of every replica on the same batch
+        """
+        policy = self.policy
+        data = policy.process(data)
+        cond = policy.create_conditioning(data)
+        target = policy.training_target(data)
+        data = {k: v for k, v in data.items() if torch.is_tensor(v)}
+
+        def replica_loss(params, buffers, cond_mask_prob):
+            # noise and cfg masking are drawn independently for every replica
+            x_noise, sigma, inputs = policy.noise_batch(
+                target, data, cond, cond_mask_prob=cond_mask_prob
+            )
+            out = functional_call(self.base, (params, buffers), inputs)
+            out = policy.denoised(out, x_noise, sigma, cond)
+            return torch.nn.functional.mse_loss(out, target)
+
+        losses = vmap(replica_loss, randomness="different")(
+            self.params, self.buffers, self.cond_mask_prob
+        )
+        # replicas do not share weights, so the summed loss gives each its own grads
+        losses.sum().backward()
+        self.optimizer_step()
+        return losses.tolist()
+
+    @torch.no_grad()
+    def optimizer_step(self):
+        """
+        AdamW with per-replica learning rates and the policy's cosine schedule
+        """
+        beta1, beta2 = self.betas
+        self.num_updates += 1
+        step = self.num_updates
+        T_max = self.cfg.policy.num_iters
+        schedule = 0.5 * (1 + math.cos(math.pi * (step - 1) / T_max))
+        for name, param in self.params.items():
+            if param.grad is None:
+                continue
+            lr = (self.lr * schedule).view(-1, *[1] * (param.dim() - 1))
+            param.mul_(1 - lr * self.weight_decay[name])
+
+            exp_avg, exp_avg_sq = self.exp_avg[name], self.exp_avg_sq[name]
+            exp_avg.lerp_(param.grad, 1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(param.grad, param.grad, value=1 - beta2)
+            denom = (exp_avg_sq / (1 - beta2**step)).sqrt_().add_(1e-8)
+            param.sub_(lr * exp_avg / (1 - beta1**step) / denom)
+            param.grad = None
+
+    def replica_state_dicts(self) -> list[dict]:
+        """
+        Model state dicts of every replica, loadable into the policy's model
+        """
+        state_dicts = []
+        for i in range(self.num_replicas):
+            state_dict = {k: v[i].detach().clone() for k, v in self.params.items()}
+            state_dict.update({k: v[i].clone() for k, v in self.buffers.items()})
+            state_dicts.append(state_dict)
+        return state_dicts
+
+    def evaluate(self) -> list[dict]:
+        """
+        Per-replica test metrics with the ema weights, in one vmapped pass
+        """
+        if self.use_ema:
+            self.ema_helper.store(self.params.values())
+            self.ema_helper.copy_to(self.params.values())
+        self.eval_mode()
+        ensemble = PolicyEnsemble(self.policy, self.replica_state_dicts())
+        with torch.inference_mode():
+            metrics = ensemble.evaluate(self.test_loader)
+        self.train_mode()
+        if self.use_ema:
+            self.ema_helper.restore(self.params.values())
+        return metrics
+
+    def save(self, path, infos=None):
+        """
+        Save every replica as a regular checkpoint, path is a directory
+        """
+        if self.use_ema:
+            self.ema_helper.store(self.params.values())
+            self.ema_helper.copy_to(self.params.values())
+
+        for i, state_dict in enumerate(self.replica_state_dicts()):
+            self.base.load_state_dict(state_dict)
+            saved_dict = {
+                "model_state_dict": self.policy.state_dict(),
+                "optimizer_state_dict": self.policy.optimizer.state_dict(),
+                "norm_state_dict": self.normalizer.state_dict(),
+                "iter": self.current_learning_iteration,
+                "infos": {**(infos or {}), "sweep": self.hparams[i]},
+            }
+            torch.save(saved_dict, os.path.join(path, f"model_{i}.pt"))
+
+        if self.use_ema:
+            self.ema_helper.restore(self.params.values())
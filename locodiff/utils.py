@@ -7,6 +7,8 @@ from functools import wraps
 import hydra
 from omegaconf import DictConfig
 
+from locodiff.lora import LoRALinear
+
 
 def dynamic_hydra_main(task_name: str):
     """
@@ -44,10 +46,25 @@ def dynamic_hydra_main(task_name: str):
     return decorator
 
 
-def apply_conditioning(x, conditions, action_dim):
-    for t, val in conditions.items():
-        x[:, t, action_dim:] = val.clone()
-    return x
+def apply_conditioning(x, cond):
+    if cond is None:
+        return x
+    return torch.where(cond["mask"], cond["value"], x)
+
+
+@torch.no_grad()
+def fold_linear_input(linear: nn.Linear | LoRALinear, scale, shift):
+    """
+    Fold an elementwise affine x * scale + shift of the input into a linear layer
+    """
+    if isinstance(linear, LoRALinear):
+        # the adapter sees the affine too, its shift term goes into the base bias
+        lora_shift = linear.lora_up.weight @ (linear.lora_down.weight @ shift)
+        linear.base.bias.add_(linear.scale * lora_shift)
+        linear.lora_down.weight.mul_(scale)
+        linear = linear.base
+    linear.bias.add_(linear.weight @ shift)
+    linear.weight.mul_(scale)
 
 
 def rand_log_logistic(
@@ -253,6 +270,34 @@ class Normalizer(nn.Module):
     def clip(self, y):
         return torch.clamp(y, self.y_bounds[0, :], self.y_bounds[1, :])
 
+    def input_affine(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Scale and shift with scale_input(x) == x * scale + shift
+        """
+        if self.scaling == "linear":
+            scale = 2 / (self.x_max - self.x_min)
+            return scale, -self.x_min * scale - 1
+        elif self.scaling == "gaussian":
+            return 1 / self.x_std, -self.x_mean / self.x_std
+        else:
+            raise ValueError(f"Unknown scaling {self.scaling}")
+
+    def output_affine(self) -> tuple[torch.Tensor, ...]:
+        """
+        Scale, shift and bounds with
+        inverse_scale_output(clip(y)) == clamp(y * scale + shift, low, high)
+        """
+        if self.scaling == "linear":
+            scale = (self.y_max - self.y_min) / 2
+            shift = scale + self.y_min
+        elif self.scaling == "gaussian":
+            scale, shift = self.y_std, self.y_mean
+        else:
+            raise ValueError(f"Unknown scaling {self.scaling}")
+        # the scale is positive, so the bounds keep their order
+        low, high = self.y_bounds * scale + shift
+        return scale, shift, low, high
+
 
 class InferenceContext:
     """
@@ -270,14 +315,14 @@ class InferenceContext:
         self.inference_mode_context.__enter__()
         self.runner.eval_mode()
         if self.use_ema:
-            self.ema_helper.store(self.policy.parameters())
-            self.ema_helper.copy_to(self.policy.parameters())
+            self.ema_helper.store(self.policy.get_params())
+            self.ema_helper.copy_to(self.policy.get_params())
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.runner.train_mode()
         if self.use_ema:
-            self.ema_helper.restore(self.policy.parameters())
+            self.ema_helper.restore(self.policy.get_params())
         self.inference_mode_context.__exit__(exc_type, exc_value, traceback)
 
 
@@ -304,6 +349,12 @@ class CFGWrapper(nn.Module):
 
         return out
 
+    def cache_cond(self, data: dict):
+        # conditioning caches do not depend on the returns
+        if hasattr(self.model, "cache_cond"):
+            return self.model.cache_cond(data)
+        return None
+
     def get_params(self):
         return self.model.get_params()
 
@@ -0,0 +1,471 @@
+import copy
+import numpy as np
+import os
+import random
+import sys
+import time
+import torch
+import torch.nn as nn
+
+import hydra
+from omegaconf import DictConfig, OmegaConf, open_dict
+
+from locodiff.benchmark import format_table, peak_memory_mb, synchronize, time_fn
+from locodiff.dataset import ExpertDataset
+from locodiff.ensemble import PolicyEnsemble
+from locodiff.envs import MazeEnv
+from locodiff.models.attention import convert_decoder_state_dict
+from locodiff.models.transformer import DiffusionTransformer
+from locodiff.profiler import ModuleProfiler, export_csv
+from locodiff.runner import DiffusionRunner
+from locodiff.utils import CFGWrapper
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.deterministic = False
+torch.backends.cudnn.benchmark = False
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(__file__), "../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/"
+)
+
+
+def make_runner(agent_cfg: DictConfig) -> DiffusionRunner:
+    # create environment
+    env = MazeEnv(agent_cfg)
+    agent_cfg.obs_dim = env.obs_dim
+    agent_cfg.act_dim = env.act_dim
+
+    # create runner
+    runner = DiffusionRunner(env, agent_cfg, device=agent_cfg.device)
+    if agent_cfg.get("checkpoint", None) is not None:
+        runner.load(agent_cfg.checkpoint)
+    runner.eval_mode()
+    return runner
+
+
+def bench_guidance(agent_cfg: DictConfig):
+    """
+    Sampling latency of CFG against value guidance with amortized gradients
+    """
+    runner = make_runner(agent_cfg)
+    policy = runner.policy
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+    model = policy.model.model if isinstance(policy.model, CFGWrapper) else policy.model
+    if policy.value_model is None:
+        policy.value_model = runner.create_value_model()
+
+    session = policy.create_session(batch_size)
+    obs = torch.zeros((batch_size, policy.obs_dim), device=runner.device)
+    session.set_goal(torch.zeros((batch_size, 2), device=runner.device))
+
+    sigma_max = policy.sigma_max
+    variants = [
+        ("none", model, 0.0, 1, sigma_max),
+        ("cfg", CFGWrapper(model, 1, 0.1), 0.0, 1, sigma_max),
+        ("value k=1", model, 1.0, 1, sigma_max),
+        ("value k=2", model, 1.0, 2, sigma_max),
+        ("value k=5", model, 1.0, 5, sigma_max),
+        ("value sigma<=1", model, 1.0, 1, 1.0),
+    ]
+    # cfg only runs its unconditional pass in eval mode
+    policy.value_model.eval()
+    rows = []
+    for name, variant, scale, every, window in variants:
+        policy.model = variant.eval()
+        policy.guide_scale = scale
+        policy.guide_every = every
+        policy.guide_sigma_max = window
+        ms = time_fn(session.act, {"obs": obs}, device=runner.device)
+        rows.append({"variant": name, "batch": batch_size, "act_ms": ms})
+    print(format_table(rows))
+
+
+@torch.no_grad()
+def bench_attention(agent_cfg: DictConfig):
+    """
+    CPU throughput of the SDPA decoder blocks against nn.TransformerDecoder,
+    run with model=transformer
+    """
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+    model_cfg = dict(agent_cfg.model)
+    model_cfg.pop("_target_", None)
+    d_model, nhead = model_cfg["d_model"], model_cfg["nhead"]
+    num_layers = model_cfg["num_layers"]
+    torch.set_num_threads(agent_cfg.get("bench_threads", torch.get_num_threads()))
+
+    rows = []
+    for T in [32, 64, 128, 256, 512]:
+        legacy = nn.TransformerDecoder(
+            nn.TransformerDecoderLayer(
+                d_model=d_model,
+                nhead=nhead,
+                dim_feedforward=4 * d_model,
+                dropout=0.0,
+                activation="gelu",
+                batch_first=True,
+                norm_first=True,
+            ),
+            num_layers=num_layers,
+        ).eval()
+        model = DiffusionTransformer(
+            **{**model_cfg, "obs_dim": 4, "act_dim": 2, "T": T, "device": "cpu"}
+        ).eval()
+
+        # load the legacy weights through the checkpoint shim
+        state_dict = {"decoder." + k: v for k, v in legacy.state_dict().items()}
+        convert_decoder_state_dict(state_dict, "", d_model)
+        model.blocks.load_state_dict(
+            {k[len("blocks.") :]: v for k, v in state_dict.items()}
+        )
+
+        x = torch.randn(batch_size, T, d_model)
+        memory = torch.randn(batch_size, 3, d_model)
+
+        def fused():
+            out = x
+            for block in model.blocks:
+                out = block(out, memory)
+            return out
+
+        error = (fused() - legacy(x, memory)).abs().max().item()
+        legacy_ms = time_fn(legacy, x, memory)
+        fused_ms = time_fn(fused)
+        rows.append(
+            {
+                "T": T,
+                "legacy_ms": legacy_ms,
+                "fused_ms": fused_ms,
+                "speedup": legacy_ms / fused_ms,
+                "max_abs_err": error,
+            }
+        )
+    print(format_table(rows))
+
+
+@torch.no_grad()
+def bench_horizon(agent_cfg: DictConfig):
+    """
+    Transformer latency and memory against horizon for each attention pattern,
+    run with model=transformer
+    """
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+    device = agent_cfg.device
+    obs_dim, act_dim = 4, 2
+    T_cond = agent_cfg.T_cond
+
+    rows = []
+    for pattern in ["full", "sliding", "dilated", "local_global"]:
+        for T in [64, 128, 256, 512, 1024]:
+            model_cfg = {
+                **{k: v for k, v in agent_cfg.model.items() if k != "_target_"},
+                "obs_dim": obs_dim,
+                "act_dim": act_dim,
+                "T": T,
+                "attn_pattern": pattern,
+                "causal": False,
+            }
+            model = DiffusionTransformer(**model_cfg).eval()
+            input_len = T + T_cond - 1 if model.inpaint else T
+            x = torch.randn(batch_size, input_len, obs_dim + act_dim, device=device)
+            sigma = torch.rand(batch_size, device=device)
+            data = {
+                "obs": torch.randn(batch_size, T_cond, obs_dim, device=device),
+                "goal": torch.randn(batch_size, obs_dim, device=device),
+            }
+            rows.append(
+                {
+                    "pattern": pattern,
+                    "T": T,
+                    "ms": time_fn(model, x, sigma, data, device=device),
+                    "peak_mb": peak_memory_mb(model, x, sigma, data, device=device),
+                }
+            )
+    print(format_table(rows))
+
+
+def bench_compile(agent_cfg: DictConfig):
+    """
+    Cold compile time and steady-state speedup of torch.compile for the train
+    step and for sampling
+    """
+    runner = make_runner(agent_cfg)
+    policy = runner.policy
+    device = runner.device
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+
+    batch = next(iter(runner.train_loader))
+    session = policy.create_session(batch_size)
+    obs = torch.zeros((batch_size, policy.obs_dim), device=device)
+    session.set_goal(torch.zeros((batch_size, 2), device=device))
+
+    def train_step():
+        policy.train()
+        policy.update(batch)
+
+    def sample():
+        policy.eval()
+        session.act({"obs": obs})
+
+    fns = {"train_step": train_step, "act": sample}
+    eager_ms = {name: time_fn(fn, device=device) for name, fn in fns.items()}
+
+    policy.compile_model(**agent_cfg.get("compile_kwargs", {}))
+    rows = []
+    for name, fn in fns.items():
+        # the first call traces and compiles
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        cold_s = time.perf_counter() - start
+        compiled_ms = time_fn(fn, device=device)
+        rows.append(
+            {
+                "fn": name,
+                "cold_compile_s": cold_s,
+                "eager_ms": eager_ms[name],
+                "compiled_ms": compiled_ms,
+                "speedup": eager_ms[name] / compiled_ms,
+            }
+        )
+    print(format_table(rows))
+
+
+def bench_checkpoint(agent_cfg: DictConfig):
+    """
+    Train step memory and throughput against the fraction of checkpointed blocks
+    """
+    runner = make_runner(agent_cfg)
+    policy = runner.policy
+    device = runner.device
+    model = policy.model.model if isinstance(policy.model, CFGWrapper) else policy.model
+    batch = next(iter(runner.train_loader))
+    batch_size = len(batch["obs"])
+    policy.train()
+
+    rows = []
+    for frac in [0.0, 0.25, 0.5, 0.75, 1.0]:
+        model.set_checkpointing(frac)
+        ms = time_fn(policy.update, batch, device=device)
+        rows.append(
+            {
+                "checkpoint_frac": frac,
+                "batch": batch_size,
+                "step_ms": ms,
+                "samples_per_s": batch_size / ms * 1e3,
+                "peak_mb": peak_memory_mb(policy.update, batch, device=device),
+            }
+        )
+    print(format_table(rows))
+
+
+def bench_models(agent_cfg: DictConfig):
+    """
+    Latency per function evaluation, sampling latency and test error of each
+    model config. Pass trained weights with +checkpoints={unet: path, mlp: path}.
+    """
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+    checkpoints = agent_cfg.get("checkpoints", {})
+    names = agent_cfg.get("bench_models", ["unet", "transformer", "mlp"])
+
+    rows = []
+    for name in names:
+        cfg = copy.deepcopy(agent_cfg)
+        with open_dict(cfg):
+            model_path = os.path.join(CONFIG_PATH, "model", f"{name}.yaml")
+            cfg.model = OmegaConf.load(model_path)
+            cfg.checkpoint = checkpoints.get(name, None)
+        runner = make_runner(cfg)
+        policy, device = runner.policy, runner.device
+
+        B = batch_size
+        x = torch.randn((B, policy.sample_len, policy.sample_dim), device=device)
+        sigma = torch.rand(B, device=device)
+        data = {
+            "obs": torch.randn((B, policy.T_cond, policy.obs_dim), device=device),
+            "goal": torch.randn((B, policy.obs_dim), device=device),
+            "returns": torch.ones((B, 1), device=device),
+        }
+        session = policy.create_session(batch_size)
+        obs = torch.zeros((batch_size, policy.obs_dim), device=device)
+        session.set_goal(torch.zeros((batch_size, 2), device=device))
+
+        with torch.no_grad():
+            nfe_ms = time_fn(policy.model, x, sigma, data, device=device)
+        # test error is only meaningful for trained weights
+        test_mse = float("nan")
+        if cfg.checkpoint is not None:
+            with torch.no_grad():
+                errors = [policy.test(batch, False)[0] for batch in runner.test_loader]
+            test_mse = float(np.mean(errors))
+
+        rows.append(
+            {
+                "model": name,
+                "params": sum(p.numel() for p in policy.get_params()),
+                "nfe_ms": nfe_ms,
+                "act_ms": time_fn(session.act, {"obs": obs}, device=device),
+                "test_mse": test_mse,
+            }
+        )
+    print(format_table(rows))
+
+
+def bench_ensemble(agent_cfg: DictConfig):
+    """
+    Per-checkpoint test metrics from one vmapped pass, against looping over
+    the checkpoints. Pass the checkpoints with +ensemble=[path, ...]
+    """
+    runner = make_runner(agent_cfg)
+    policy, device = runner.policy, runner.device
+    paths = list(agent_cfg.ensemble)
+
+    synchronize(device)
+    start = time.perf_counter()
+    looped = []
+    for path in paths:
+        runner.load(path)
+        runner.eval_mode()
+        with torch.no_grad():
+            looped.append(
+                np.mean([policy.test(batch, False)[0] for batch in runner.test_loader])
+            )
+    synchronize(device)
+    loop_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ensemble = PolicyEnsemble.from_checkpoints(policy, paths)
+    rows = ensemble.evaluate(runner.test_loader)
+    synchronize(device)
+    vmap_s = time.perf_counter() - start
+
+    for row, path, mse in zip(rows, paths, looped):
+        row["model"] = os.path.basename(os.path.dirname(os.path.dirname(path)))
+        row["looped_mse"] = float(mse)
+    print(format_table(rows))
+    print(f"looped: {loop_s:.2f}s, vmapped: {vmap_s:.2f}s")
+
+
+def bench_fuse(agent_cfg: DictConfig):
+    """
+    Sampling latency and plan difference of a policy with the normalizer folded
+    into the models, against the unfused policy on the same noise
+    """
+    runner = make_runner(agent_cfg)
+    policy, device = runner.policy, runner.device
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+    obs = torch.randn((batch_size, policy.obs_dim), device=device)
+    goal = torch.randn((batch_size, 2), device=device)
+
+    def act():
+        session = policy.create_session(batch_size)
+        session.set_goal(goal)
+        torch.manual_seed(agent_cfg.seed)
+        return session.act({"obs": obs})
+
+    with torch.no_grad():
+        unfused = act()
+        unfused_ms = time_fn(act, device=device)
+        policy.fuse_normalizer()
+        fused = act()
+        fused_ms = time_fn(act, device=device)
+
+    rows = [
+        {
+            "output": k,
+            "max_abs_error": (fused[k] - unfused[k]).abs().max().item(),
+            "unfused_ms": unfused_ms,
+            "fused_ms": fused_ms,
+        }
+        for k in unfused
+    ]
+    print(format_table(rows))
+
+
+def bench_dataset(agent_cfg: DictConfig):
+    """
+    Load time and memory of the ragged episode storage against the padded
+    layout. Isaac datasets are read with dataset.data_directory=<path>, and
+    dataset.mmap_dir=<dir> times the memory-mapped backend
+    """
+    cfg = agent_cfg.dataset
+    start = time.perf_counter()
+    dataset = ExpertDataset(
+        cfg.data_directory, cfg.T_cond, cfg.task_name, mmap_dir=cfg.mmap_dir
+    )
+    load_s = time.perf_counter() - start
+    rows = [
+        {
+            "task": cfg.task_name,
+            "episodes": len(dataset),
+            "steps": dataset.lengths.sum().item(),
+            "max_len": dataset.lengths.max().item(),
+            "load_s": load_s,
+            **dataset.memory_report(),
+        }
+    ]
+    print(format_table(rows))
+
+
+def bench_profile(agent_cfg: DictConfig):
+    """
+    Per-module params, FLOPs, latency and memory of one denoiser call, up to
+    +profile_depth levels deep. Write the table with +profile_csv=<path>.
+    Run without compile, compiled cores bypass the module hooks.
+    """
+    runner = make_runner(agent_cfg)
+    policy, device = runner.policy, runner.device
+    model = policy.model
+    if isinstance(model, CFGWrapper):
+        model = model.model
+
+    B = agent_cfg.get("bench_batch_size", 64)
+    x = torch.randn((B, policy.sample_len, policy.sample_dim), device=device)
+    sigma = torch.rand(B, device=device)
+    data = {
+        "obs": torch.randn((B, policy.T_cond, policy.obs_dim), device=device),
+        "goal": torch.randn((B, policy.obs_dim), device=device),
+        "returns": torch.ones((B, 1), device=device),
+    }
+
+    profiler = ModuleProfiler(model, device, agent_cfg.get("profile_depth", 4))
+    rows = profiler.profile(x, sigma, data)
+    print(format_table(rows))
+    if agent_cfg.get("profile_csv", None) is not None:
+        export_csv(rows, agent_cfg.profile_csv)
+
+
+@hydra.main(
+    config_path="../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/",
+    config_name="maze_cfg.yaml",
+    version_base=None,
+)
+def main(agent_cfg: DictConfig):
+    """Benchmark locodiff models and samplers."""
+    # set random seed
+    random.seed(agent_cfg.seed)
+    np.random.seed(agent_cfg.seed)
+    torch.manual_seed(agent_cfg.seed)
+
+    # pick a benchmark with +bench=<name>
+    benchmarks = {
+        "guidance": bench_guidance,
+        "attention": bench_attention,
+        "horizon": bench_horizon,
+        "compile": bench_compile,
+        "checkpoint": bench_checkpoint,
+        "models": bench_models,
+        "ensemble": bench_ensemble,
+        "profile": bench_profile,
+        "fuse": bench_fuse,
+        "dataset": bench_dataset,
+    }
+    benchmarks[agent_cfg.get("bench", "guidance")](agent_cfg)
+
+
+if __name__ == "__main__":
+    # run the main function
+    sys.argv.append("hydra.output_subdir=null")
+    sys.argv.append("hydra.run.dir=.")
+    main()
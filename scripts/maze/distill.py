@@ -0,0 +1,118 @@
+import copy
+import numpy as np
+import os
+import random
+import torch
+
+import hydra
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import DictConfig, OmegaConf, open_dict
+
+from locodiff.benchmark import format_table, time_fn
+from locodiff.envs import MazeEnv
+from locodiff.runner import DiffusionRunner
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.deterministic = False
+torch.backends.cudnn.benchmark = False
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(__file__), "../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/"
+)
+
+
+@torch.no_grad()
+def compare(student: DiffusionRunner, teacher: DiffusionRunner, batch_size: int):
+    """
+    Per-step latency and plan error of the student against the teacher
+    """
+    device = student.device
+    rows = []
+    for name, runner in [("teacher", teacher), ("student", student)]:
+        policy = runner.policy
+        policy.eval()
+        B = batch_size
+        x = torch.randn((B, policy.sample_len, policy.sample_dim), device=device)
+        sigma = torch.rand(B, device=device)
+        data = {
+            "obs": torch.randn((B, policy.T_cond, policy.obs_dim), device=device),
+            "goal": torch.randn((B, policy.obs_dim), device=device),
+            "returns": torch.ones((B, 1), device=device),
+        }
+        rows.append(
+            {
+                "model": name,
+                "params": sum(p.numel() for p in policy.get_params()),
+                "nfe_ms": time_fn(policy.model, x, sigma, data, device=device),
+            }
+        )
+
+    # plans from the same initial noise, against the data and the teacher
+    data_mse, teacher_mse, student_mse = [], [], []
+    for seed, batch in enumerate(teacher.test_loader):
+        data = teacher.policy.process(batch)
+        target = teacher.normalizer.inverse_scale_output(data["input"])
+        torch.manual_seed(seed)
+        teacher_plan = teacher.policy(data)
+        torch.manual_seed(seed)
+        student_plan = student.policy(data)
+        data_mse.append(torch.mean((teacher_plan - target) ** 2).item())
+        student_mse.append(torch.mean((student_plan - target) ** 2).item())
+        teacher_mse.append(torch.mean((student_plan - teacher_plan) ** 2).item())
+
+    rows[0].update(plan_mse=float(np.mean(data_mse)), plan_mse_to_teacher=0.0)
+    rows[1].update(
+        plan_mse=float(np.mean(student_mse)),
+        plan_mse_to_teacher=float(np.mean(teacher_mse)),
+    )
+    print(format_table(rows))
+
+
+@hydra.main(
+    config_path="../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/",
+    config_name="maze_cfg.yaml",
+    version_base=None,
+)
+def main(agent_cfg: DictConfig):
+    """
+    Distill a trained teacher into the configured model, e.g.
+    model=mlp +teacher=unet +teacher_checkpoint=<path>
+    """
+    log_dir = HydraConfig.get().runtime.output_dir
+    print(f"[INFO] Logging experiment in directory: {log_dir}")
+
+    # set random seed
+    random.seed(agent_cfg.seed)
+    np.random.seed(agent_cfg.seed)
+    torch.manual_seed(agent_cfg.seed)
+
+    # create environment
+    env = MazeEnv(agent_cfg)
+    agent_cfg.obs_dim = env.obs_dim
+    agent_cfg.act_dim = env.act_dim
+
+    # teacher from its own model config and checkpoint
+    teacher_cfg = copy.deepcopy(agent_cfg)
+    with open_dict(teacher_cfg):
+        teacher_path = os.path.join(CONFIG_PATH, "model", f"{agent_cfg.teacher}.yaml")
+        teacher_cfg.model = OmegaConf.load(teacher_path)
+    teacher = DiffusionRunner(env, teacher_cfg, device=agent_cfg.device)
+    teacher.load(agent_cfg.teacher_checkpoint)
+    teacher.eval_mode()
+
+    # student is trained and saved like a regular model
+    student = DiffusionRunner(env, agent_cfg, log_dir=log_dir, device=agent_cfg.device)
+    student.distill(teacher.policy, agent_cfg.get("distill_iters", agent_cfg.num_iters))
+
+    # evaluate the ema weights that were saved
+    if student.use_ema:
+        student.ema_helper.copy_to(student.policy.get_params())
+    compare(student, teacher, agent_cfg.get("bench_batch_size", 64))
+
+    env.close()
+
+
+if __name__ == "__main__":
+    # run the main function
+    main()
@@ -0,0 +1,61 @@
+import numpy as np
+import os
+import random
+import torch
+
+import hydra
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import DictConfig, OmegaConf
+
+from locodiff.envs import MazeEnv
+from locodiff.runner import DiffusionRunner
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.deterministic = False
+torch.backends.cudnn.benchmark = False
+
+
+@hydra.main(
+    config_path="../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/",
+    config_name="maze_cfg.yaml",
+    version_base=None,
+)
+def main(agent_cfg: DictConfig):
+    """
+    Fine-tune LoRA adapters of a trained model on a new task, e.g.
+    task=PointMaze_Large-v3 num_iters=5e4 +checkpoint=<path>
+    """
+    log_dir = HydraConfig.get().runtime.output_dir
+    print(f"[INFO] Logging experiment in directory: {log_dir}")
+
+    # set random seed
+    random.seed(agent_cfg.seed)
+    np.random.seed(agent_cfg.seed)
+    torch.manual_seed(agent_cfg.seed)
+
+    # create environment
+    env = MazeEnv(agent_cfg)
+    agent_cfg.obs_dim = env.obs_dim
+    agent_cfg.act_dim = env.act_dim
+
+    # frozen base model with trainable adapters
+    runner = DiffusionRunner(env, agent_cfg, log_dir=log_dir, device=agent_cfg.device)
+    runner.load(agent_cfg.checkpoint)
+    runner.current_learning_iteration = 0
+    runner.add_adapters(**OmegaConf.to_container(agent_cfg.lora))
+    num_params = sum(p.numel() for p in runner.policy.get_params())
+    print(f"[INFO] Training {num_params} adapter parameters")
+
+    # checkpoints only hold the adapters
+    runner.learn()
+    adapter_path = os.path.join(log_dir, "models", "model.pt")
+    size_mb = os.path.getsize(adapter_path) / 2**20
+    print(f"[INFO] Adapters saved to {adapter_path} ({size_mb:.2f} MB)")
+
+    env.close()
+
+
+if __name__ == "__main__":
+    # run the main function
+    main()
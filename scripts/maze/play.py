@@ -52,6 +52,9 @@ def main(agent_cfg: DictConfig):
     resume_path = os.path.join(get_latest_run(log_root_path), "models/model.pt")
     print(f"[INFO]: Loading model checkpoint from: {resume_path}")
     runner.load(resume_path)
+    # task adapters on top of the base model
+    if agent_cfg.get("adapters", None) is not None:
+        runner.load_adapters(agent_cfg.adapters)
     runner.eval_mode()
 
     # TODO: make plotting function
@@ -103,7 +106,10 @@ def main(agent_cfg: DictConfig):
 
     elif test_type == "play":
         # obtain the trained policy for inference
-        policy = runner.get_inference_policy(device=env.device)
+        policy = runner.get_inference_policy(
+            device=env.device,
+            fuse_normalizer=agent_cfg.get("fuse_normalizer", False),
+        )
 
         # make figure
         plt.figure(figsize=(8, 8))
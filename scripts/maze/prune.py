@@ -0,0 +1,126 @@
+import copy
+import numpy as np
+import random
+import torch
+from tqdm import trange
+
+import hydra
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import DictConfig, open_dict
+
+from locodiff.benchmark import format_table, time_fn
+from locodiff.envs import MazeEnv
+from locodiff.prune import activation_scores, prune_unet
+from locodiff.runner import DiffusionRunner
+from locodiff.utils import CFGWrapper
+
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.deterministic = False
+torch.backends.cudnn.benchmark = False
+
+
+def unwrap(runner: DiffusionRunner):
+    model = runner.policy.model
+    return model.model if isinstance(model, CFGWrapper) else model
+
+
+def evaluate(name: str, runner: DiffusionRunner, batch_size: int) -> dict:
+    """
+    Per-step latency and test MSE of a runner's policy
+    """
+    policy, device = runner.policy, runner.device
+    B = batch_size
+    x = torch.randn((B, policy.sample_len, policy.sample_dim), device=device)
+    sigma = torch.rand(B, device=device)
+    data = {
+        "obs": torch.randn((B, policy.T_cond, policy.obs_dim), device=device),
+        "goal": torch.randn((B, policy.obs_dim), device=device),
+        "returns": torch.ones((B, 1), device=device),
+    }
+    runner.eval_mode()
+    with torch.no_grad():
+        nfe_ms = time_fn(policy.model, x, sigma, data, device=device)
+        test_mse = [policy.test(batch, False)[0] for batch in runner.test_loader]
+    return {
+        "model": name,
+        "params": sum(p.numel() for p in policy.get_params()),
+        "nfe_ms": nfe_ms,
+        "test_mse": float(np.mean(test_mse)),
+    }
+
+
+@hydra.main(
+    config_path="../../isaac_ext/isaac_ext/tasks/diffusion/config/maze/",
+    config_name="maze_cfg.yaml",
+    version_base=None,
+)
+def main(agent_cfg: DictConfig):
+    """
+    Prune the hidden channels of a trained UNet and fine-tune it, e.g.
+    +checkpoint=<path> +prune_ratio=0.5 +prune_score=activation
+    """
+    log_dir = HydraConfig.get().runtime.output_dir
+    print(f"[INFO] Logging experiment in directory: {log_dir}")
+    batch_size = agent_cfg.get("bench_batch_size", 64)
+
+    # set random seed
+    random.seed(agent_cfg.seed)
+    np.random.seed(agent_cfg.seed)
+    torch.manual_seed(agent_cfg.seed)
+
+    # create environment
+    env = MazeEnv(agent_cfg)
+    agent_cfg.obs_dim = env.obs_dim
+    agent_cfg.act_dim = env.act_dim
+
+    # trained model
+    runner = DiffusionRunner(env, agent_cfg, device=agent_cfg.device)
+    runner.load(agent_cfg.checkpoint)
+    runner.eval_mode()
+    rows = [evaluate("original", runner, batch_size)]
+
+    # score and prune
+    scores = None
+    if agent_cfg.get("prune_score", "magnitude") == "activation":
+        scores = activation_scores(runner.policy, runner.train_loader, num_batches=10)
+    widths, state_dict = prune_unet(
+        unwrap(runner), agent_cfg.get("prune_ratio", 0.5), scores
+    )
+
+    # rebuild at the pruned widths, with a fresh optimizer and ema
+    pruned_cfg = copy.deepcopy(agent_cfg)
+    with open_dict(pruned_cfg):
+        pruned_cfg.model.block_channels = widths
+    pruned = DiffusionRunner(env, pruned_cfg, log_dir=log_dir, device=agent_cfg.device)
+    unwrap(pruned).load_state_dict(state_dict)
+    pruned.normalizer.load_state_dict(runner.normalizer.state_dict())
+    pruned.ema_helper.load_shadow_params(pruned.policy.get_params())
+    rows.append(evaluate("pruned", pruned, batch_size))
+
+    # short fine-tune
+    pruned.train_mode()
+    generator = iter(pruned.train_loader)
+    for _ in trange(int(agent_cfg.get("prune_finetune_iters", 5000)), desc="Tuning"):
+        try:
+            batch = next(generator)
+        except StopIteration:
+            generator = iter(pruned.train_loader)
+            batch = next(generator)
+        pruned.policy.update(batch)
+        pruned.ema_helper.update(pruned.policy.get_params())
+
+    pruned.save(f"{log_dir}/models/model.pt", infos={"block_channels": widths})
+    # evaluate the ema weights that were saved
+    if pruned.use_ema:
+        pruned.ema_helper.copy_to(pruned.policy.get_params())
+    rows.append(evaluate("pruned + fine-tuned", pruned, batch_size))
+    print(format_table(rows))
+    print(f"[INFO] Load the pruned model with model.block_channels={widths}")
+
+    env.close()
+
+
+if __name__ == "__main__":
+    # run the main function
+    main()
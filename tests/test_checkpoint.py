@@ -0,0 +1,139 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+from torch.optim.adamw import AdamW
+
+from locodiff.models.transformer import DiffusionTransformer
+from locodiff.policy import DiffusionPolicy
+from locodiff.runner import DiffusionRunner
+from locodiff.utils import Normalizer
+
+obs_dim, act_dim, T, T_cond, B = 4, 2, 8, 2, 3
+d_model, nhead, num_layers = 16, 2, 2
+
+stats = SimpleNamespace(
+    x_min=-torch.ones(obs_dim),
+    x_max=torch.ones(obs_dim),
+    x_mean=torch.zeros(obs_dim),
+    x_std=torch.ones(obs_dim),
+    y_min=-torch.ones(obs_dim + act_dim),
+    y_max=torch.ones(obs_dim + act_dim),
+    y_mean=torch.zeros(obs_dim + act_dim),
+    y_std=torch.ones(obs_dim + act_dim),
+)
+loader = SimpleNamespace(
+    dataset=SimpleNamespace(dataset=SimpleNamespace(dataset=stats))
+)
+
+
+def make_policy():
+    model = DiffusionTransformer(
+        obs_dim=obs_dim,
+        act_dim=act_dim,
+        d_model=d_model,
+        nhead=nhead,
+        num_layers=num_layers,
+        T=T,
+        T_cond=T_cond,
+        cond_mask_prob=0.0,
+        emb_dropout=0.0,
+        attn_dropout=0.0,
+        weight_decay=1e-3,
+        inpaint=False,
+        device="cpu",
+    )
+    return DiffusionPolicy(
+        model=model,
+        normalizer=Normalizer(loader, "linear", "cpu"),
+        env=None,
+        obs_dim=obs_dim,
+        act_dim=act_dim,
+        T=T,
+        T_cond=T_cond,
+        T_action=1,
+        num_envs=B,
+        sampling_steps=3,
+        sigma_data=0.5,
+        sigma_min=0.001,
+        sigma_max=80.0,
+        cond_lambda=1,
+        cond_mask_prob=0.0,
+        lr=1e-4,
+        betas=(0.9, 0.999),
+        num_iters=10,
+        inpaint=False,
+        device="cpu",
+    )
+
+
+# a checkpoint saved before the decoder rewrite, with nn.TransformerDecoder
+# weights, the causal mask buffer and the optimizer groups of that layout
+policy = make_policy()
+decoder = nn.TransformerDecoder(
+    nn.TransformerDecoderLayer(
+        d_model=d_model,
+        nhead=nhead,
+        dim_feedforward=4 * d_model,
+        dropout=0.0,
+        activation="gelu",
+        batch_first=True,
+        norm_first=True,
+    ),
+    num_layers=num_layers,
+)
+model_state_dict = {
+    k: v for k, v in policy.state_dict().items() if not k.startswith("model.blocks.")
+}
+for k, v in decoder.state_dict().items():
+    model_state_dict["model.decoder." + k] = v
+model_state_dict["model.mask"] = torch.zeros(T, T)
+
+block_params = {id(p) for p in policy.model.blocks.parameters()}
+decay, no_decay = [
+    [p for p in group["params"] if id(p) not in block_params]
+    for group in policy.model.get_optim_groups()
+]
+for name, param in decoder.named_parameters():
+    if name.endswith("weight") and "norm" not in name:
+        decay.append(param)
+    else:
+        no_decay.append(param)
+legacy_optimizer = AdamW([{"params": decay}, {"params": no_decay}])
+for group in legacy_optimizer.param_groups:
+    for param in group["params"]:
+        param.grad = torch.randn_like(param)
+legacy_optimizer.step()
+
+checkpoint = {
+    "model_state_dict": model_state_dict,
+    "optimizer_state_dict": legacy_optimizer.state_dict(),
+    "norm_state_dict": policy.normalizer.state_dict(),
+    "iter": 7,
+    "infos": None,
+}
+
+# load it into a fresh runner
+runner = DiffusionRunner.__new__(DiffusionRunner)
+runner.policy = make_policy()
+runner.normalizer = runner.policy.normalizer
+runner.autoencoder = None
+with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, "model.pt")
+    torch.save(checkpoint, path)
+    runner.load(path)
+assert runner.current_learning_iteration == 7
+
+# the converted blocks compute the same function as the legacy decoder
+decoder.eval()
+runner.policy.eval()
+x = torch.randn(B, T, d_model)
+memory = torch.randn(B, T_cond + 2, d_model)
+with torch.no_grad():
+    out = x
+    for block in runner.policy.model.blocks:
+        out = block(out, memory)
+    expected = decoder(x, memory)
+assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
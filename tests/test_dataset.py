@@ -0,0 +1,63 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Subset
+
+from locodiff.dataset import ExpertDataset, SlicerWrapper, WindowLoader
+
+obs_dim, act_dim, T_cond, T = 3, 2, 3, 4
+window = T_cond + T - 1
+# shorter than, as long as and longer than a window, counting the padding
+lengths = [1, 2, 4, 5, 9]
+episodes = [(torch.randn(n, obs_dim), torch.randn(n, act_dim)) for n in lengths]
+
+# ragged buffers, without running the loading of ExpertDataset
+dataset = ExpertDataset.__new__(ExpertDataset)
+dataset.T_cond = T_cond
+dataset.device = "cpu"
+dataset.lengths = torch.tensor(lengths)
+dataset.offsets = torch.cumsum(dataset.lengths, dim=0) - dataset.lengths
+dataset.data = {
+    "obs": dataset.concat_eps([obs for obs, _ in episodes]),
+    "action": dataset.concat_eps([actions for _, actions in episodes]),
+}
+indices = [4, 0, 2, 3, 1]
+slicer = SlicerWrapper(Subset(dataset, indices), T_cond, T)
+
+# slices of the former padded layout, where each episode is left padded with
+# T_cond - 1 steps and its length counts that padding
+slices = []
+for i in indices:
+    length = lengths[i] + T_cond - 1
+    if length >= window:
+        slices += [(i, start) for start in range(length - window + 1)]
+    else:
+        slices += [(i, start) for start in range(length - 1)]
+
+assert len(slicer) == len(slices), f"{len(slicer)}, {len(slices)}"
+episode_ids = torch.as_tensor(indices)[slicer.episodes.long()].tolist()
+assert list(zip(episode_ids, slicer.starts.tolist())) == slices
+
+# windows of the padded layout, zero before the episode start and past its end
+max_len = max(lengths)
+padded = {
+    key: torch.stack(
+        [F.pad(ep[i], (0, 0, T_cond - 1, max_len - len(ep[i]))) for ep in episodes]
+    )
+    for i, key in enumerate(["obs", "action"])
+}
+expected = {
+    k: torch.stack([v[i, start : start + window] for i, start in slices])
+    for k, v in padded.items()
+}
+
+for idx in range(len(slicer)):
+    item = slicer[idx]
+    for k, v in expected.items():
+        assert torch.equal(item[k], v[idx]), f"{k} window {idx}: {slices[idx]}"
+
+buffers = (dataset.data, dataset.offsets, dataset.lengths)
+loader = WindowLoader(slicer, batch_size=4, shuffle=False, buffers=buffers)
+batches = list(loader)
+assert len(batches) == len(loader)
+for k, v in expected.items():
+    assert torch.equal(torch.cat([batch[k] for batch in batches]), v), k
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import torch
+
+from locodiff.models.mlp import DiffusionMLPSieve
+from locodiff.policy import DiffusionPolicy
+from locodiff.utils import Normalizer
+
+obs_dim, act_dim, T, T_cond, B = 4, 2, 8, 2, 3
+
+# normalizer stats, reached through loader.dataset.dataset.dataset
+stats = SimpleNamespace(
+    x_min=-torch.rand(obs_dim),
+    x_max=torch.rand(obs_dim) + 1,
+    x_mean=torch.randn(obs_dim),
+    x_std=torch.rand(obs_dim) + 0.5,
+    y_min=-torch.rand(obs_dim + act_dim),
+    y_max=torch.rand(obs_dim + act_dim) + 1,
+    y_mean=torch.randn(obs_dim + act_dim),
+    y_std=torch.rand(obs_dim + act_dim) + 0.5,
+)
+loader = SimpleNamespace(
+    dataset=SimpleNamespace(dataset=SimpleNamespace(dataset=stats))
+)
+
+for scaling in ["linear", "gaussian"]:
+    model = DiffusionMLPSieve(
+        obs_dim=obs_dim,
+        act_dim=act_dim,
+        T=T,
+        T_cond=T_cond,
+        n_emb=16,
+        n_hidden=32,
+        cond_mask_prob=0.0,
+        weight_decay=0.0,
+        inpaint=False,
+        device="cpu",
+    )
+    policy = DiffusionPolicy(
+        model=model,
+        normalizer=Normalizer(loader, scaling, "cpu"),
+        env=None,
+        obs_dim=obs_dim,
+        act_dim=act_dim,
+        T=T,
+        T_cond=T_cond,
+        T_action=1,
+        num_envs=B,
+        sampling_steps=3,
+        sigma_data=0.5,
+        sigma_min=0.001,
+        sigma_max=80.0,
+        cond_lambda=1,
+        cond_mask_prob=0.0,
+        lr=1e-4,
+        betas=(0.9, 0.999),
+        num_iters=10,
+        inpaint=False,
+        device="cpu",
+    )
+    policy.add_adapters(rank=2)
+    # the adapters start as a no-op, give them weights so the fold is tested
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if "lora_up" in name:
+                param.normal_()
+    policy.eval()
+
+    x = torch.randn(B, T, obs_dim + act_dim)
+    sigma = torch.rand(B)
+    obs = torch.randn(B, T_cond, obs_dim)
+    goal = torch.randn(B, obs_dim)
+    returns = torch.rand(B, 1)
+
+    with torch.no_grad():
+        scaled = {
+            "obs": policy.normalizer.scale_input(obs),
+            "goal": policy.normalizer.scale_input(goal),
+            "returns": returns,
+        }
+        expected = model(x, sigma, scaled)
+        policy.fuse_normalizer()
+        out = model(x, sigma, {"obs": obs, "goal": goal, "returns": returns})
+
+    assert torch.allclose(
+        out, expected, atol=1e-4
+    ), f"{scaling}: max error {(out - expected).abs().max()}"
@@ -0,0 +1,70 @@
+import torch
+
+from locodiff.models.transformer import DiffusionTransformer
+
+obs_dim, act_dim, T, T_cond, B = 4, 2, 8, 2, 3
+torch.manual_seed(0)
+
+
+def uncached(model, x, sigma, data):
+    """
+    Forward pass that embeds the whole memory and projects its keys and values
+    in every block, as before the cache
+    """
+    sigma_emb = model.sigma_emb(sigma.view(-1, 1, 1))
+    obs_emb = model.obs_emb(data["obs"])
+    goal_emb = model.obs_emb(data["goal"]).unsqueeze(1)
+    memory = torch.cat([obs_emb, goal_emb], dim=1)
+    mod = None
+    if model.sigma_cond == "token":
+        memory = torch.cat([sigma_emb, memory], dim=1)
+    else:
+        mod = sigma_emb.squeeze(1)
+    memory = memory + model.cond_pos_emb
+
+    x = model.input_emb(x) + model.pos_emb
+    for block in model.blocks:
+        x = block(x, memory=memory, mod=mod, is_causal=model.causal)
+    return model.output_pred(model.ln_f(x))
+
+
+for sigma_cond in ["token", "adaln"]:
+    model = DiffusionTransformer(
+        obs_dim=obs_dim,
+        act_dim=act_dim,
+        d_model=16,
+        nhead=2,
+        num_layers=2,
+        T=T,
+        T_cond=T_cond,
+        cond_mask_prob=0.0,
+        emb_dropout=0.0,
+        attn_dropout=0.0,
+        weight_decay=0.0,
+        inpaint=False,
+        device="cpu",
+        sigma_cond=sigma_cond,
+    ).eval()
+    # adaLN-Zero starts as the identity, randomize it so sigma matters
+    with torch.no_grad():
+        for block in model.blocks:
+            if block.modulation is not None:
+                block.modulation[-1].weight.normal_(std=0.1)
+
+    x = torch.randn(B, T, obs_dim + act_dim)
+    data = {
+        "obs": torch.randn(B, T_cond, obs_dim),
+        "goal": torch.randn(B, obs_dim),
+        "returns": torch.rand(B, 1),
+    }
+    with torch.no_grad():
+        # one cache is reused over the denoising steps
+        cached = {**data, "cond_cache": model.cache_cond(data)}
+        for sigma in [torch.full((B,), 0.1), torch.full((B,), 2.0)]:
+            expected = uncached(model, x, sigma, data)
+            out = model(x, sigma, cached)
+            assert torch.allclose(out, expected, atol=1e-5), (
+                sigma_cond,
+                (out - expected).abs().max(),
+            )
+            assert torch.allclose(model(x, sigma, data), expected, atol=1e-5)
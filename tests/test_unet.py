@@ -0,0 +1,61 @@
+import torch
+import torch.nn.functional as F
+
+from locodiff.models.unet import (
+    ConditionalResidualBlock1D,
+    ConditionalUnet1D,
+    Downsample1d,
+)
+
+B, C, cond_dim = 3, 16, 5
+torch.manual_seed(0)
+
+block = ConditionalResidualBlock1D(8, C, cond_dim, kernel_size=5)
+cond = torch.randn(B, cond_dim)
+
+for T in [5, 6, 7]:
+    x = torch.randn(B, 8, T)
+    expected = block(x, cond)
+
+    # a mask of ones is the unmasked path
+    ones = torch.ones(1, 1, T)
+    assert torch.allclose(block(x, cond, ones), expected, atol=1e-5), T
+
+    # masked padding leaves the valid steps as without padding
+    T_pad = T + 3
+    mask = (torch.arange(T_pad) < T).float().view(1, 1, -1)
+    out = block(F.pad(x, (0, T_pad - T)), cond, mask)
+    assert torch.allclose(out[..., :T], expected, atol=1e-5), T
+    assert (out[..., T:] == 0).all(), T
+
+model = ConditionalUnet1D(
+    obs_dim=2,
+    act_dim=2,
+    T_cond=2,
+    cond_embed_dim=8,
+    down_dims=[16, 32, 64],
+    device="cpu",
+    cond_mask_prob=0.0,
+    weight_decay=0.0,
+    inpaint=False,
+).eval()
+factor = 2 ** (len(model.down_modules) - 1)
+
+for T in range(5, 13):
+    T_pad = -(-T // factor) * factor
+    # the masks follow the valid lengths of unpadded stride 2 convs
+    length = T
+    for mask in model.padding_masks(T, T_pad, "cpu", torch.float):
+        assert mask.sum() == length, (T, mask)
+        length = Downsample1d(1)(torch.zeros(1, 1, length)).shape[-1]
+
+    x = torch.randn(B, T, 4)
+    data = {
+        "obs": torch.randn(B, 2, 2),
+        "goal": torch.randn(B, 2),
+        "returns": torch.rand(B, 1),
+    }
+    with torch.no_grad():
+        out = model(x, torch.rand(B), data)
+    assert out.shape == (B, T, 4), (T, out.shape)
+    assert torch.isfinite(out).all(), T